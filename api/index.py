@@ -1,43 +1,42 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 import os
 import sys
+import hashlib
+from datetime import datetime, timezone
 # ==================== Vercel 关键修复 ====================
 # 把项目根目录加入 Python 路径，这样才能 import lib
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import requests
-from notion_client import APIResponseError, Client
-from dotenv import load_dotenv
-from pprint import pprint
-import time
-from redis import Redis
-from redis.exceptions import ConnectionError as RedisConnectionError
 
-from lib.utils import get_cmc_field_data, now_with_timezone
-from lib.notion import notion_get, notion_update, notion_get_holdings_rows, notion_create_account_snapshot,\
-                        notion_get_pending_or_error_holdings, mark_holdings_as_error, mark_holdings_as_synced,\
-                        sync_summary_for_new_holdings_rows
-
-
-
-
-# 加载环境变量
-load_dotenv()
+from lib.config import env, missing_env
+from lib.utils import now_with_timezone
+from lib.prices import get_price_data, get_cached_price_data
+from lib.cmc import cmc_credits_used_today
+from lib.timeseries import ts_load, ts_symbols
+from lib.metrics import register_request_metrics, render_prometheus
+from lib.stream import stream_events, stream_subscriber_count
+from lib.write_queue import notion_enqueue_price_updates, notion_drain_write_queue, write_queue_stats
+from lib.jobs import JobBusy, run_market_price_job, run_account_snapshot_job, run_summary_sync_job
+from lib.notion import notion_concurrency, get_notion_client, notion_get, notion_update, notion_get_holdings_rows, notion_create_account_snapshot,\
+                        notion_get_pending_or_error_holdings, mark_holdings_as_error,\
+                        sync_summary_for_new_holdings_rows, get_holdings_sync_watermark, save_holdings_sync_watermark
+
+
+# 冷启动只导入 Flask 与轻量模块：
+# - Redis / Notion 客户端在首次使用时才连接 / 创建（lib.redis.get_redis / lib.notion.get_notion_client）
+# - 环境变量（含 .env）在请求中按需读取（lib.config.env）
+# - numpy 相关模块（analytics / valuation）在对应路由内导入
 
 app = Flask(__name__)
 
 # === Import Redis module ===
-from lib.redis import redis_client, CACHE_TTL, CACHE_KEY_PREFIX
+from lib.redis import CACHE_SOFT_TTL, l1_quote_cache, get_redis
 
 
-# --- 环境变量配置 (在 Vercel 中设置) ---
-CMC_API_KEY = os.environ.get("CMC_API_KEY")
-NOTION_TOKEN = os.environ.get("NOTION_TOKEN")
-NOTION_DATABASE_ID = os.environ.get("NOTION_DATABASE_ID")
-NOTION_HOLDINGS_DATABASE_ID = os.environ["NOTION_HOLDINGS_DATABASE_ID"]
-NOTION_SNAPSHOT_DATABASE_ID = os.environ["NOTION_SNAPSHOT_DATABASE_ID"]
-NOTION_SUMMARY_DATABASE_ID = os.environ["NOTION_SUMMARY_DATABASE_ID"]
-API_SECRET = os.getenv("API_SECRET")
+# --- 环境变量（在 Vercel 中设置），请求内通过 env() 读取 ---
+# CMC_API_KEY / NOTION_TOKEN / NOTION_DATABASE_ID / NOTION_HOLDINGS_DATABASE_ID /
+# NOTION_SNAPSHOT_DATABASE_ID / NOTION_SUMMARY_DATABASE_ID / API_SECRET
 
 
 # --- Notion 属性名 ---
@@ -45,122 +44,193 @@ NOTION_SYMBOL_PROPERTY_NAME = "Symbol"
 NOTION_PRICE_PROPERTY_NAME = "Price"
 NOTION_CHANGE_24H_PROPERTY_NAME = "24H Change"
 
-CMC_BASE_URL = "https://pro-api.coinmarketcap.com/v2/cryptocurrency/quotes/latest"
-
+# 请求耗时埋点（Server-Timing 响应头），先于 Token 验证注册，401 也会被统计
+register_request_metrics(app)
 
 # 注册 Token 验证中间件
 from lib.utils import register_token_verifier
-register_token_verifier(app)
+register_token_verifier(app, exempt_endpoints=("health",))
+
+
+def job_budget():
+    """
+    可恢复任务的时间预算（Query 参数 budget，秒）
+
+    未传时返回 None，路由按原逻辑一次执行完；传入时需要 Redis 保存 checkpoint
+    """
+    budget = request.args.get("budget")
+    if budget is None:
+        return None
+    budget = float(budget)
+    if budget <= 0:
+        raise ValueError("budget must be positive")
+    return budget
+
+
+def job_response(result):
+    """可恢复任务的响应：has_more 为 true 时再次调用同一接口继续执行"""
+    job = result.pop("job")
+    return jsonify({
+        "status": "in_progress" if job["has_more"] else "success",
+        "has_more": job["has_more"],
+        "progress": job["progress"],
+        "run_id": job["run_id"],
+        "resumed": job["resumed"],
+        "elapsed": job["elapsed"],
+        **result
+    }), 200
+
+
+def job_unavailable():
+    return jsonify({"error": "Resumable jobs require Redis"}), 503
+
+
+def notion_currency_rates():
+    """
+    Notion 中价格的货币（环境变量 NOTION_PRICE_CURRENCY，默认 USD）与参考汇率
+
+    返回 (currency, rates, error)：error 不为 None 时为应直接返回的错误响应；
+    配置了 REFERENCE_CURRENCIES 时顺带按汇率表自身的 TTL 刷新参考汇率
+    """
+    currency = env("NOTION_PRICE_CURRENCY", "USD").strip().upper()
+    if currency == "USD" and not env("REFERENCE_CURRENCIES"):
+        return currency, None, None
+
+    from lib.rates import reference_currencies, get_reference_rates
+    if currency not in reference_currencies():
+        return currency, None, (jsonify({"error": f"NOTION_PRICE_CURRENCY {currency} is not in REFERENCE_CURRENCIES"}), 500)
+    rates = get_reference_rates(env("CMC_API_KEY"))
+    if currency not in rates:
+        return currency, rates, (jsonify({"error": "Reference rate unavailable", "currency": currency}), 503)
+    return currency, rates, None
+
+
+def write_queue_unavailable():
+    return jsonify({"error": "Write queue requires Redis"}), 503
+
+
+def job_busy(e):
+    return jsonify({"status": "busy", "message": str(e)}), 409
+
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    """健康检查：不读取配置、不连接 Redis / Notion / CMC，免 Token"""
+    return jsonify({"status": "ok"}), 200
+
 
 @app.route('/api/cron-update-cache', methods=['GET'])
 def cron_update_cache():
-    if not all([CMC_API_KEY, NOTION_TOKEN, NOTION_DATABASE_ID]):
+    """
+    刷新报价并更新 Crypto Market 数据库
+
+    请求参数（Query）：
+    - mode: sync（默认）在本请求内写入 Notion；queue 只把页面更新写入队列（write-behind），
+      由 /api/drain-notion-queue 分批写入。默认值可通过环境变量 NOTION_WRITE_MODE 设置
+    - rebuild_index: 1 时全量扫描 Crypto Market 重建 symbol → page 索引；默认按 last_edited_time 增量刷新
+    - budget: 本次调用的时间预算（秒）。传入时分段执行并在 Redis 保存进度，
+      返回 has_more=true 时再次调用继续；不传则一次执行完
+
+    写入 Notion 的价格货币由环境变量 NOTION_PRICE_CURRENCY 设置（默认 USD），
+    配置了 REFERENCE_CURRENCIES 时顺带按汇率表自身的 TTL 刷新参考汇率
+    """
+    if missing_env("CMC_API_KEY", "NOTION_TOKEN", "NOTION_DATABASE_ID"):
         return jsonify({"error": "Missing environment variables."}), 500
 
     try:
-         
-        notion = Client(auth=NOTION_TOKEN)
-        symbols_list = notion_get(notion, NOTION_DATABASE_ID, NOTION_SYMBOL_PROPERTY_NAME)
-        # === 缓存逻辑：批量读取已有缓存 ===
-        price_data = {}
-        symbols_to_fetch = []
-
-        for symbol in symbols_list:
-            cache_key_price = f"{CACHE_KEY_PREFIX}{symbol}:price"
-            cache_key_change = f"{CACHE_KEY_PREFIX}{symbol}:change"
-
-            cached_price = redis_client.get(cache_key_price) if redis_client else None
-            cached_change = redis_client.get(cache_key_change) if redis_client else None
-
-            if cached_price and cached_change:
-                price_data[symbol] = {
-                    "price": float(cached_price),
-                    "change_24h": float(cached_change)
-                }
-                print(f"Cache hit: {symbol} | price={cached_price} | change={cached_change}")
-                continue
-
-            symbols_to_fetch.append(symbol)
-
-
-        # === 如果全部命中缓存，直接跳过请求 ===
-        if not symbols_to_fetch:
-            print("All prices from cache!")
-        else:
-            print(f"Fetching {len(symbols_to_fetch)} symbols from CMC: {symbols_to_fetch}")
-
-            # 构造请求参数
-            symbols_str = ",".join(symbols_to_fetch)
-            headers = {
-                "Accept": "application/json",
-                "X-CMC_PRO_API_KEY": CMC_API_KEY,
-            }
-            params = {
-                "symbol": symbols_str,
-                "convert": "USD"
-            }
-
-            try:
-                cmc_response = requests.get(CMC_BASE_URL, headers=headers, params=params, timeout=15)
-                cmc_response.raise_for_status()
-                cmc_data = cmc_response.json()
-
-                # 写入缓存 + 收集价格
-                for symbol in symbols_to_fetch:
-                    try:
-                        # 价格
-                        price = get_cmc_field_data(cmc_data, symbol, "price")
-
-                        # 24小时涨跌幅
-                        change_24h = get_cmc_field_data(cmc_data, symbol, "percent_change_24h")
-
-                        # 放入本地数据结构
-                        price_data[symbol] = {
-                            "price": price,
-                            "change_24h": change_24h
-                        }
-
-                        # 缓存
-                        if redis_client:
-                            redis_client.setex(f"{CACHE_KEY_PREFIX}{symbol}:price", CACHE_TTL, price)
-                            redis_client.setex(f"{CACHE_KEY_PREFIX}{symbol}:change", CACHE_TTL, change_24h)
-                            print(f"Fresh {symbol}: ${price:,.4f} -> cached for 5min")
-                    except Exception as e:
-                        print(f"获取 {symbol} 失败: {e}")
-                        price_data[symbol] = None
-
-            except requests.exceptions.RequestException as e:
-                print("CMC 请求失败:", e)
-                # CMC 请求失败 fallback（读取旧缓存）
-                cached_price = redis_client.get(f"{CACHE_KEY_PREFIX}{symbol}:price")
-                cached_change = redis_client.get(f"{CACHE_KEY_PREFIX}{symbol}:change")
-
-                if cached_price and cached_change:
-                    price_data[symbol] = {
-                        "price": float(cached_price),
-                        "change_24h": float(cached_change)
-                    }
-                    print(f"Fallback to old cache for {symbol}")
-                else:
-                    price_data[symbol] = None
-
+        budget = job_budget()
+    except ValueError as e:
+        return jsonify({"error": "Value error", "message": str(e)}), 400
 
+    try:
+        notion = get_notion_client(env("NOTION_TOKEN"))
+        queue_mode = request.args.get("mode", env("NOTION_WRITE_MODE", "sync")) == "queue"
+        if queue_mode and not get_redis():
+            return write_queue_unavailable()
+
+        currency, rates, error = notion_currency_rates()
+        if error:
+            return error
+
+        if budget is not None:
+            if not get_redis():
+                return job_unavailable()
+            return job_response(run_market_price_job(
+                notion,
+                env("CMC_API_KEY"),
+                env("NOTION_DATABASE_ID"),
+                NOTION_SYMBOL_PROPERTY_NAME,
+                NOTION_PRICE_PROPERTY_NAME,
+                NOTION_CHANGE_24H_PROPERTY_NAME,
+                budget,
+                queue=queue_mode,
+                rebuild_index=request.args.get("rebuild_index") == "1",
+                currency=currency,
+                rates=rates
+            ))
+
+        symbol_to_page = notion_get(
+            notion,
+            env("NOTION_DATABASE_ID"),
+            NOTION_SYMBOL_PROPERTY_NAME,
+            rebuild=request.args.get("rebuild_index") == "1"
+        )
+        symbols_list = sorted(symbol_to_page)
+        # === 报价：新鲜缓存直接使用，过期 / 缺失的 symbol 同步请求 CMC（写入 Notion 不用过期价格）===
+        price_data = get_price_data(env("CMC_API_KEY"), symbols_list, refresh_stale=True)
+        notion_prices = price_data
+        if currency != "USD":
+            from lib.rates import price_data_in
+            notion_prices = price_data_in(price_data, currency, rates)
+
+        if queue_mode:
+            # write-behind：只入队，不等待 Notion 写入
+            queued = notion_enqueue_price_updates(
+                symbol_to_page,
+                notion_prices,
+                NOTION_PRICE_PROPERTY_NAME,
+                NOTION_CHANGE_24H_PROPERTY_NAME
+            )
+            return jsonify({
+                "status": "Queued",
+                **queued,
+                "queue": write_queue_stats(),
+                "currency": currency,
+                "symbols": symbols_list,
+                "quotes": price_data,
+                "cmc_credits_today": cmc_credits_used_today()
+            }), 200
 
         # 更新 Notion 页面
-        updated_count = notion_update(
+        update_results = notion_update(
             notion,
-            price_data,
+            symbol_to_page,
+            notion_prices,
             NOTION_PRICE_PROPERTY_NAME,
             NOTION_CHANGE_24H_PROPERTY_NAME
         )
+        failed = {
+            symbol: result["error"]
+            for symbol, result in update_results.items()
+            if result["status"] == "error"
+        }
+        suppressed = sum(1 for result in update_results.values() if result["status"] == "suppressed")
 
 
         return jsonify({
             "status": "Success",
-            "updated": updated_count,
-            "symbols": symbols_list
+            "updated": len(update_results) - len(failed) - suppressed,
+            "suppressed": suppressed,
+            "failed": failed,
+            "currency": currency,
+            "symbols": symbols_list,
+            "quotes": price_data,
+            "cmc_credits_today": cmc_credits_used_today()
         }), 200
 
+    except JobBusy as e:
+        return job_busy(e)
+
     except ValueError as e:
         return jsonify({"status": "Success", "message": "No symbols found"}), 200
 
@@ -179,58 +249,289 @@ def cron_update_cache():
 
 
 
+@app.route('/api/drain-notion-queue', methods=['GET'])
+def drain_notion_queue():
+    """
+    把 write-behind 队列中的页面更新分批写入 Notion（受令牌桶 / 自适应并发限制）
+
+    请求参数（Query）：
+    - limit: 本次最多处理的任务数，默认 500
+    """
+    if missing_env("NOTION_TOKEN"):
+        return jsonify({"error": "Missing environment variables."}), 500
+
+    try:
+        limit = int(request.args.get("limit", 500))
+    except ValueError as e:
+        return jsonify({"error": "Value error", "message": str(e)}), 400
+
+    if not get_redis():
+        return write_queue_unavailable()
+
+    try:
+        notion = get_notion_client(env("NOTION_TOKEN"))
+        return jsonify(notion_drain_write_queue(notion, limit=limit)), 200
+    except Exception as e:
+        return jsonify({"error": "Queue drain failed", "message": str(e)}), 500
+
+
+@app.route('/api/prices', methods=['GET'])
+def get_prices():
+    """
+    只读批量价格接口（不访问 Notion）
+
+    请求参数（Query）：
+    - symbols: 逗号分隔的币种，如 BTC,ETH
+    - refresh: 1 时缓存缺失/过期的 symbol 走 CMC（stale-while-revalidate），默认只读缓存
+    - currency: 计价货币，默认 USD；其他货币须在 REFERENCE_CURRENCIES 中，由缓存的 USD 报价 × 参考汇率本地换算
+      （change_24h 仍为 USD 计价的涨跌幅）
+
+    支持 ETag / If-None-Match：数据未变化时返回 304
+    """
+    symbols = [s.strip().upper() for s in request.args.get("symbols", "").split(",") if s.strip()]
+    if not symbols:
+        return jsonify({"error": "Missing symbols"}), 400
+
+    currency = request.args.get("currency", "USD").strip().upper()
+    if currency != "USD":
+        from lib.rates import reference_currencies
+        if currency not in reference_currencies():
+            return jsonify({"error": f"Unsupported currency: {currency}"}), 400
+
+    if request.args.get("refresh") == "1":
+        if missing_env("CMC_API_KEY"):
+            return jsonify({"error": "Missing environment variables."}), 500
+        price_data = get_price_data(env("CMC_API_KEY"), symbols)
+    else:
+        price_data = get_cached_price_data(symbols)
+
+    if currency != "USD":
+        from lib.rates import get_reference_rates, price_data_in
+        # refresh=1 时汇率表过期也会刷新，否则只读缓存的汇率
+        rates = get_reference_rates(env("CMC_API_KEY") if request.args.get("refresh") == "1" else None)
+        if currency not in rates:
+            return jsonify({"error": "Reference rate unavailable", "currency": currency}), 503
+        price_data = price_data_in(price_data, currency, rates)
+
+    # 紧凑结构：symbol -> [price, change_24h, 抓取时间戳]，age 由客户端按 ts 计算，保证 ETag 稳定
+    body = {
+        "currency": currency,
+        "data": {
+            symbol: [quote["price"], quote["change_24h"], round(quote["ts"], 3)]
+            for symbol, quote in price_data.items() if quote
+        },
+        "missing": [symbol for symbol in symbols if not price_data.get(symbol)]
+    }
+
+    response = jsonify(body)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+
+    # 缓存时长 = 最旧报价剩余的新鲜时间
+    max_age = min(
+        (CACHE_SOFT_TTL - quote["age"] for quote in price_data.values() if quote),
+        default=0
+    )
+    response.cache_control.private = True
+    response.cache_control.max_age = max(int(max_age), 0)
+
+    return response.make_conditional(request)
+
+
+@app.route('/api/prices/stream', methods=['GET'])
+def stream_prices():
+    """
+    价格推送（Server-Sent Events）：每次刷新写入新报价时推送一条增量
+
+    请求参数：
+    - symbols（Query）: 逗号分隔的币种，只推送这些币种；默认全部
+    - Last-Event-ID（Header，或 Query last_event_id）: 断线重连时从该事件之后续传；
+      超出回放缓冲时先收到 reset 事件，应重新拉取 /api/prices
+
+    事件格式：event: prices，data 为 {symbol: [price, change_24h, 抓取时间戳]}
+    """
+    symbols = {s.strip().upper() for s in request.args.get("symbols", "").split(",") if s.strip()}
+    try:
+        last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError as e:
+        return jsonify({"error": "Value error", "message": str(e)}), 400
+
+    if not get_redis():
+        return jsonify({"error": "Price stream requires Redis"}), 503
+
+    return Response(
+        stream_with_context(stream_events(symbols, last_event_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+
+@app.route('/api/analytics', methods=['GET'])
+def get_analytics():
+    """
+    基于本地价格时间序列的统计分析（不请求 CMC）
+
+    请求参数（Query）：
+    - symbols: 逗号分隔的币种，默认所有有记录的币种
+    - window: 滚动波动率窗口（点数，至少 2），默认 12
+    - limit: 每个币种最多使用的最近点数，默认（0）全部
+    """
+    from lib.analytics import compute_analytics
+
+    try:
+        symbols = [s.strip().upper() for s in request.args.get("symbols", "").split(",") if s.strip()]
+        window = int(request.args.get("window", 12))
+        limit = int(request.args.get("limit", 0)) or None
+        if window < 2:
+            raise ValueError("window must be at least 2")
+        if limit is not None and limit < 0:
+            raise ValueError("limit must not be negative")
+    except ValueError as e:
+        return jsonify({"error": "Value error", "message": str(e)}), 400
+
+    series = ts_load(symbols or ts_symbols(), **({"limit": limit} if limit else {}))
+    if not series:
+        return jsonify({"status": "skipped", "message": "No price history"}), 200
+
+    return jsonify(compute_analytics(series, window=window)), 200
+
+
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus 文本格式的进程内指标
+
+    - 接口 / 各上游阶段（redis、cmc、notion）耗时直方图
+    - 上游调用次数（按状态码）与重试次数、Notion 自适应并发上限
+    - write-behind 队列深度与积压延迟
+    - 报价缓存各层命中情况、L1 缓存统计、当日 CMC credit
+    """
+    l1_stats = l1_quote_cache.stats()
+    gauges = {
+        f"l1_cache_{name}": value
+        for name, value in l1_stats.items()
+    }
+    gauges["notion_concurrency_limit"] = notion_concurrency.limit
+    gauges["notion_in_flight"] = notion_concurrency.in_flight
+    gauges["stream_subscribers"] = stream_subscriber_count()
+    try:
+        gauges["cmc_credits_today"] = cmc_credits_used_today()
+        queue = write_queue_stats()
+        gauges["notion_write_queue_depth"] = queue["depth"]
+        gauges["notion_write_queue_lag_seconds"] = queue["lag_seconds"]
+    except Exception as e:
+        print("读取 Redis 指标失败:", e)
+
+    return render_prometheus(gauges), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 @app.route('/api/update-account-snapshot', methods=['GET'])
 def update_account_snapshot():
     """
     更新账户快照（Account Snapshot）
 
     功能：
-    - 从 Holdings 数据库读取当前持仓
+    - 读取当前持仓（默认使用缓存的持仓数量 × 价格缓存，在服务内估值；Holdings 修改后缓存失效）
     - 计算账户总市值 / 总投入 / 总盈亏
     - 写入一条 Snapshot 记录到 Snapshot 数据库
 
     请求参数（Query）：
     - timezone: IANA 时区名（默认 UTC），如 Asia/Tokyo
+    - source: engine（默认，服务内估值）或 notion（读取 Notion 公式 当前市值 / 总买入成本）
+      engine 按 NOTION_PRICE_CURRENCY 换算价格，与 Notion 中的成本 / 市值使用同一货币
+    - refresh_holdings: 1 时重新读取 Holdings 刷新持仓缓存
+    - budget: 本次调用的时间预算（秒），传入时分页读取 Holdings 并在 Redis 保存进度，
+      返回 has_more=true 时再次调用继续；快照时间取第一次调用的时间，Snapshot 只写入一次
 
     返回：
     - 账户统计汇总信息
     """
+    from notion_client import APIResponseError
+    from lib.valuation import compute_portfolio_valuation
+
+    if missing_env("NOTION_TOKEN", "NOTION_HOLDINGS_DATABASE_ID", "NOTION_SNAPSHOT_DATABASE_ID"):
+        return jsonify({"error": "Missing environment variables."}), 500
+
     try:
         # 读取并生成快照时间
         tz_name = request.args.get("timezone", "UTC")
         snapshot_time = now_with_timezone(tz_name)
-
-        notion = Client(auth=NOTION_TOKEN)
-
-        holdings = notion_get_holdings_rows(
-            notion,
-            NOTION_HOLDINGS_DATABASE_ID
-        )
-
-        # 计算账户级指标
-        total_market_value = 0.0   # 账户总市值
-        total_invested = 0.0       # 账户总投入（历史买入成本）
-
-        for row in holdings:
-            props = row["properties"]
-
-            # 当前市值（Formula 字段）
-            total_market_value += props["当前市值"]["formula"]["number"] or 0
-
-            # 总买入成本（Rollup 字段）
-            total_invested += props["总买入成本"]["rollup"]["number"] or 0
-
-        # 总盈亏 = 当前市值 - 总投入
-        total_pnl = total_market_value - total_invested
+        budget = job_budget()
+
+        notion = get_notion_client(env("NOTION_TOKEN"))
+        assets = None
+        source = request.args.get("source", "engine")
+
+        currency, rates = "USD", None
+        if source != "notion":
+            currency, rates, error = notion_currency_rates()
+            if error:
+                return error
+
+        if budget is not None:
+            if not get_redis():
+                return job_unavailable()
+            return job_response(run_account_snapshot_job(
+                notion,
+                env("CMC_API_KEY"),
+                env("NOTION_HOLDINGS_DATABASE_ID"),
+                env("NOTION_SNAPSHOT_DATABASE_ID"),
+                snapshot_time,
+                source,
+                budget,
+                refresh_positions=request.args.get("refresh_holdings") == "1",
+                currency=currency,
+                rates=rates
+            ))
+
+        if source == "notion":
+            holdings = notion_get_holdings_rows(
+                notion,
+                env("NOTION_HOLDINGS_DATABASE_ID")
+            )
+
+            # 计算账户级指标（逐行流式累加，不保留整表）
+            total_market_value = 0.0   # 账户总市值
+            total_invested = 0.0       # 账户总投入（历史买入成本）
+            asset_count = 0            # 资产数量
+
+            for row in holdings:
+                props = row["properties"]
+                asset_count += 1
+
+                # 当前市值（Formula 字段）
+                total_market_value += props["当前市值"]["formula"]["number"] or 0
+
+                # 总买入成本（Rollup 字段）
+                total_invested += props["总买入成本"]["rollup"]["number"] or 0
+
+            # 总盈亏 = 当前市值 - 总投入
+            total_pnl = total_market_value - total_invested
+        else:
+            valuation = compute_portfolio_valuation(
+                notion,
+                env("CMC_API_KEY"),
+                env("NOTION_HOLDINGS_DATABASE_ID"),
+                refresh_positions=request.args.get("refresh_holdings") == "1",
+                currency=currency,
+                rates=rates
+            )
+            total_market_value = valuation["total_market_value"]
+            total_invested = valuation["total_invested"]
+            total_pnl = valuation["total_pnl"]
+            asset_count = valuation["asset_count"]
+            assets = {"assets": valuation["assets"], "unpriced": valuation["unpriced"]}
 
         # 写入 Snapshot 数据库
         notion_create_account_snapshot(
             notion,
-            NOTION_SNAPSHOT_DATABASE_ID,
+            env("NOTION_SNAPSHOT_DATABASE_ID"),
             total_market_value,
             total_invested,
             total_pnl,
-            len(holdings),
+            asset_count,
             snapshot_time
         )
 
@@ -241,10 +542,14 @@ def update_account_snapshot():
             "总市值": total_market_value,
             "总投入": total_invested,
             "总盈亏": total_pnl,
-            "资产数量": len(holdings)
+            "资产数量": asset_count,
+            **(assets or {})
         })
 
     # ❌ 异常处理（分类型）
+    except JobBusy as e:
+        return job_busy(e)
+
     except APIResponseError as e:
         # Notion API 返回的错误（403 / 404 / 429 等）
         return jsonify({
@@ -282,32 +587,72 @@ def sync_crypto_summary():
     - 程序自动筛选新增 Holdings（pending）
     - 同步 Summary（继承账本）
     - 保证唯一性
-    - 成功后标记 synced，失败标记 error
+    - 每行写入一次最终状态：synced / skipped / error
+
+    请求参数（Query）：
+    - full: 1 时忽略增量水位，全量筛选；默认只查看上次成功运行后修改过的行
+    - rebuild_index: 1 时从 Notion 全量重建 Summary 去重索引
+    - budget: 本次调用的时间预算（秒），传入时分段同步并在 Redis 保存进度，
+      返回 has_more=true 时再次调用继续；全部完成后才推进增量水位
     """
+    from lib.valuation import invalidate_positions
+
+    if missing_env("NOTION_TOKEN", "NOTION_HOLDINGS_DATABASE_ID", "NOTION_SUMMARY_DATABASE_ID"):
+        return jsonify({"error": "Missing environment variables."}), 500
+
+    try:
+        budget = job_budget()
+    except ValueError as e:
+        return jsonify({"error": "Value error", "message": str(e)}), 400
+
+    holdings_db_id = env("NOTION_HOLDINGS_DATABASE_ID")
+    new_rows = []
     try:
-        notion = Client(auth=NOTION_TOKEN)
+        notion = get_notion_client(env("NOTION_TOKEN"))
+
+        if budget is not None:
+            if not get_redis():
+                return job_unavailable()
+            # 分段同步内部已把失败段的行标记为 error
+            return job_response(run_summary_sync_job(
+                notion,
+                holdings_db_id,
+                env("NOTION_SUMMARY_DATABASE_ID"),
+                budget,
+                full=request.args.get("full") == "1",
+                rebuild_index=request.args.get("rebuild_index") == "1"
+            ))
+
+        # ① 筛选“新增的 Holdings”（服务端筛选 + 增量水位）
+        scan_started_at = datetime.now(timezone.utc)
+        since = None if request.args.get("full") == "1" else get_holdings_sync_watermark(holdings_db_id)
 
-        # ① 筛选“新增的 Holdings”
         new_rows = notion_get_pending_or_error_holdings(
             notion,
-            NOTION_HOLDINGS_DATABASE_ID
+            holdings_db_id,
+            since=since
         )
 
         if not new_rows:
+            save_holdings_sync_watermark(holdings_db_id, scan_started_at)
             return jsonify({
                 "status": "skipped",
                 "message": "No pending holdings"
             }), 200
 
-        # ② 同步 Summary（原子）
+        # ② 同步 Summary，并为每行写入最终状态（synced / skipped / error）
         result = sync_summary_for_new_holdings_rows(
             notion=notion,
             new_holdings_rows=new_rows,
-            SUMMARY_DB_ID=NOTION_SUMMARY_DATABASE_ID
+            SUMMARY_DB_ID=env("NOTION_SUMMARY_DATABASE_ID"),
+            rebuild_index=request.args.get("rebuild_index") == "1"
         )
 
-        # ③ 标记为 synced
-        mark_holdings_as_synced(notion, new_rows)
+        # 有行的状态没写进去时不推进水位，下次增量扫描仍能看到它们
+        if not result["status_failed_count"]:
+            save_holdings_sync_watermark(holdings_db_id, scan_started_at)
+        # 有新增/变更的 Holdings：估值引擎的持仓缓存失效
+        invalidate_positions(holdings_db_id)
 
         return jsonify({
             "status": "success",
@@ -315,6 +660,9 @@ def sync_crypto_summary():
             **result
         }), 200
 
+    except JobBusy as e:
+        return job_busy(e)
+
     except Exception as e:
         # ❌ 出错则标记 error
         try:
@@ -0,0 +1,132 @@
+"""
+离线端到端 benchmark：本地模拟 CMC / Notion，经 Flask test client 驱动三个主要接口
+
+用法：
+    python bench/bench_endpoints.py --sizes 10,100,1000 --latency-ms 20 --notion-rps 0 --out bench_output.json
+
+每个数据规模在独立子进程中运行（全新的模块状态 / FakeRedis / 内存统计），
+输出为 JSON：每个接口的耗时、状态码、上游调用次数、429 次数与峰值内存。
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = [
+    ("cron-update-cache (cold)", "/api/cron-update-cache"),
+    ("cron-update-cache (warm)", "/api/cron-update-cache"),
+    ("update-account-snapshot", "/api/update-account-snapshot"),
+    ("sync-crypto-summary", "/api/sync-crypto-summary"),
+]
+
+
+def _git_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def run_scenario(size, latency_ms, notion_rps, notion_client_rps):
+    """在当前进程内运行一个数据规模（由子进程调用）"""
+    from fake_upstreams import FakeUpstreams
+
+    upstreams = FakeUpstreams(size, latency_ms=latency_ms, notion_rps=notion_rps).start()
+    os.environ.update({
+        "CMC_API_KEY": "bench",
+        "CMC_API_BASE": upstreams.cmc_url,
+        "NOTION_TOKEN": "bench",
+        "NOTION_BASE_URL": upstreams.notion_url,
+        "NOTION_REQUESTS_PER_SECOND": str(notion_client_rps),
+        "NOTION_DATABASE_ID": FakeUpstreams.DATABASE_IDS["market"],
+        "NOTION_HOLDINGS_DATABASE_ID": FakeUpstreams.DATABASE_IDS["holdings"],
+        "NOTION_SNAPSHOT_DATABASE_ID": FakeUpstreams.DATABASE_IDS["snapshot"],
+        "NOTION_SUMMARY_DATABASE_ID": FakeUpstreams.DATABASE_IDS["summary"],
+        "API_SECRET": "bench",
+    })
+    os.environ.pop("REDIS_URL", None)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        from api.index import app
+    client = app.test_client()
+
+    results = []
+    for name, path in ENDPOINTS:
+        before = upstreams.stats.snapshot()
+        tracemalloc.start()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.get(path, headers={"x-api-token": "bench"})
+        wall = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        after = upstreams.stats.snapshot()
+
+        results.append({
+            "endpoint": name,
+            "status_code": response.status_code,
+            "wall_time_s": round(wall, 4),
+            "peak_memory_kb": round(peak / 1024, 1),
+            "upstream_calls": {
+                key: count - before["calls"].get(key, 0)
+                for key, count in after["calls"].items()
+                if count - before["calls"].get(key, 0)
+            },
+            "rate_limited": after["rate_limited"] - before["rate_limited"],
+        })
+
+    upstreams.stop()
+    return {"size": size, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark")
+    parser.add_argument("--sizes", default="10,100,1000", help="逗号分隔的数据规模（symbol / holdings 行数）")
+    parser.add_argument("--latency-ms", type=float, default=20, help="模拟上游每个请求的延迟")
+    parser.add_argument("--notion-rps", type=int, default=0, help="模拟 Notion 每秒请求上限，超出返回 429（0 不限流）")
+    parser.add_argument("--client-rps", type=float, default=1000, help="服务端令牌桶速率（NOTION_REQUESTS_PER_SECOND）")
+    parser.add_argument("--out", help="结果写入文件（默认输出到 stdout）")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_scenario(args.child, args.latency_ms, args.notion_rps, args.client_rps)))
+        return
+
+    report = {
+        "version": _git_version(),
+        "python": platform.python_version(),
+        "params": {"latency_ms": args.latency_ms, "notion_rps": args.notion_rps, "client_rps": args.client_rps},
+        "scenarios": []
+    }
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), "--child", str(size),
+            "--latency-ms", str(args.latency_ms), "--notion-rps", str(args.notion_rps),
+            "--client-rps", str(args.client_rps)
+        ])
+        report["scenarios"].append(json.loads(output.decode().strip().splitlines()[-1]))
+        print(f"size={size} done", file=sys.stderr)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+冷启动 benchmark：在全新子进程中测量 api/index.py 的导入耗时与每个路由的首次请求耗时
+
+用法：
+    python bench/bench_startup.py --runs 10 --out startup_output.json
+
+- 每次运行都是新的解释器（等同 Vercel 冷启动），上游使用本地模拟的 CMC / Notion
+- 报告 import 耗时、各路由首个请求耗时（含懒加载 Redis / Notion 客户端）与导入时已加载的重量级模块
+- --importtime N：额外用 python -X importtime 统计一次，列出累计耗时最高的 N 个模块
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_REQUESTS = [
+    ("health", "/api/health"),
+    ("prices (cache only)", "/api/prices?symbols=C00001,C00002"),
+    ("prices (refresh)", "/api/prices?symbols=C00001,C00002&refresh=1"),
+    ("cron-update-cache", "/api/cron-update-cache"),
+]
+HEAVY_MODULES = ("redis", "notion_client", "httpx", "numpy", "requests", "dotenv")
+
+
+def _git_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def run_child():
+    """子进程：导入应用并依次发起首个请求（上游地址由父进程通过环境变量传入）"""
+    sys.path.insert(0, ROOT)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        from api.index import app
+    import_ms = (time.perf_counter() - started) * 1000
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    client = app.test_client()
+    requests_ms = {}
+    for name, path in FIRST_REQUESTS:
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.get(path, headers={"x-api-token": "bench"})
+        requests_ms[name] = {"ms": round((time.perf_counter() - started) * 1000, 2), "status_code": response.status_code}
+
+    return {"import_ms": round(import_ms, 2), "loaded_at_import": loaded, "first_requests": requests_ms}
+
+
+def _summary(values):
+    return {
+        "median": round(statistics.median(values), 2),
+        "min": round(min(values), 2),
+        "max": round(max(values), 2)
+    }
+
+
+def _top_imports(env, limit):
+    """用 -X importtime 统计导入 api.index 时累计耗时最高的模块"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import api.index"],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].strip()))
+    return [{"module": name, "cumulative_ms": round(us / 1000, 2)} for us, name in sorted(rows, reverse=True)[:limit]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark")
+    parser.add_argument("--runs", type=int, default=10, help="冷启动次数（每次一个新子进程）")
+    parser.add_argument("--latency-ms", type=float, default=20, help="模拟上游每个请求的延迟")
+    parser.add_argument("--size", type=int, default=100, help="模拟 Crypto Market 数据库的 symbol 数")
+    parser.add_argument("--importtime", type=int, default=0, help="额外列出导入耗时最高的 N 个模块")
+    parser.add_argument("--out", help="结果写入文件（默认输出到 stdout）")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child()))
+        return
+
+    from fake_upstreams import FakeUpstreams
+
+    upstreams = FakeUpstreams(args.size, latency_ms=args.latency_ms).start()
+    env = dict(os.environ)
+    env.update({
+        "CMC_API_KEY": "bench",
+        "CMC_API_BASE": upstreams.cmc_url,
+        "NOTION_TOKEN": "bench",
+        "NOTION_BASE_URL": upstreams.notion_url,
+        "NOTION_REQUESTS_PER_SECOND": "1000",
+        "NOTION_DATABASE_ID": FakeUpstreams.DATABASE_IDS["market"],
+        "NOTION_HOLDINGS_DATABASE_ID": FakeUpstreams.DATABASE_IDS["holdings"],
+        "NOTION_SNAPSHOT_DATABASE_ID": FakeUpstreams.DATABASE_IDS["snapshot"],
+        "NOTION_SUMMARY_DATABASE_ID": FakeUpstreams.DATABASE_IDS["summary"],
+        "API_SECRET": "bench",
+    })
+    env.pop("REDIS_URL", None)
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child"], env=env, cwd=ROOT)
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    report = {
+        "version": _git_version(),
+        "python": platform.python_version(),
+        "params": {"runs": args.runs, "latency_ms": args.latency_ms, "size": args.size},
+        "import_ms": _summary([run["import_ms"] for run in runs]),
+        "loaded_at_import": runs[-1]["loaded_at_import"],
+        "first_request_ms": {
+            name: _summary([run["first_requests"][name]["ms"] for run in runs])
+            for name, _ in FIRST_REQUESTS
+        },
+        "status_codes": {name: runs[-1]["first_requests"][name]["status_code"] for name, _ in FIRST_REQUESTS}
+    }
+    if args.importtime:
+        report["top_imports"] = _top_imports(env, args.importtime)
+    upstreams.stop()
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+本地模拟的 CoinMarketCap / Notion HTTP 服务（仅 benchmark 使用）
+
+- 可配置每个请求的延迟、Notion 429 限流阈值和数据规模
+- 记录每个上游路由的调用次数，供 benchmark 报告
+"""
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class UpstreamStats:
+    def __init__(self):
+        self.calls = Counter()
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+    def record(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def record_429(self):
+        with self._lock:
+            self.rate_limited += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "rate_limited": self.rate_limited}
+
+
+class _RateWindow:
+    """固定 1 秒窗口计数，超过 rps 返回 429（rps <= 0 表示不限流）"""
+
+    def __init__(self, rps):
+        self.rps = rps
+        self._window = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if self.rps <= 0:
+            return True
+        with self._lock:
+            now = int(time.monotonic())
+            if now != self._window:
+                self._window, self._count = now, 0
+            self._count += 1
+            return self._count <= self.rps
+
+
+def build_dataset(size):
+    """生成 Crypto Market / Holdings / Summary / Snapshot 四个数据库的行"""
+    symbols = [f"C{i:05d}" for i in range(size)]
+    market = [
+        {
+            "object": "page",
+            "id": f"market-{i}",
+            "last_edited_time": "2026-01-01T00:00:00.000Z",
+            "properties": {"Symbol": {"type": "rich_text", "rich_text": [{"plain_text": symbol}]}}
+        }
+        for i, symbol in enumerate(symbols)
+    ]
+    holdings = [
+        {
+            "object": "page",
+            "id": f"holding-{i}",
+            "last_edited_time": "2026-01-01T00:00:00.000Z",
+            "properties": {
+                "币种": {"type": "title", "title": [{"plain_text": symbol}]},
+                "账本": {"type": "relation", "relation": [{"id": f"ledger-{i % 3}"}]},
+                "Summary Sync Status": {"type": "select", "select": None},
+                "当前持仓数量": {"type": "number", "number": 1.0 + i % 10},
+                "当前市值": {"type": "formula", "formula": {"type": "number", "number": 100.0 + i}},
+                "总买入成本": {"type": "rollup", "rollup": {"type": "number", "number": 50.0 + i}}
+            }
+        }
+        for i, symbol in enumerate(symbols)
+    ]
+    return {"market": market, "holdings": holdings, "summary": [], "snapshot": []}
+
+
+def _make_handler(name, route, latency, stats, limiter):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # 头和响应体分两次写出，不关闭 Nagle 时每个响应会叠加约 40ms 的 delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+            if latency:
+                time.sleep(latency)
+            if limiter and not limiter.allow():
+                stats.record_429()
+                return self._send(429, {
+                    "object": "error", "status": 429, "code": "rate_limited",
+                    "message": "You have been rate limited. Please try again in a few minutes."
+                }, {"Retry-After": "1"})
+            status, call, payload = route(method, urlparse(self.path), body)
+            stats.record(f"{name}:{call}")
+            self._send(status, payload)
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_PATCH(self):
+            self._handle("PATCH")
+
+    return Handler
+
+
+def _edited_now():
+    """Notion 的 last_edited_time 精确到分钟"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:00.000Z")
+
+
+def _matches(row, query_filter):
+    """只支持顶层 last_edited_time 时间戳条件，其余条件视为全部匹配"""
+    since = (query_filter or {}).get("last_edited_time", {}).get("on_or_after")
+    if query_filter and query_filter.get("timestamp") == "last_edited_time" and since:
+        edited = datetime.fromisoformat(row["last_edited_time"].replace("Z", "+00:00"))
+        return edited >= datetime.fromisoformat(since.replace("Z", "+00:00"))
+    return True
+
+
+def _notion_route(dataset, database_ids):
+    by_database = {database_ids[name]: name for name in database_ids}
+    pages = {row["id"]: row for rows in dataset.values() for row in rows}
+    lock = threading.Lock()
+
+    def route(method, url, body):
+        path = url.path
+        m = re.fullmatch(r"/v1/databases/([^/]+)", path)
+        if m and method == "GET":
+            return 200, "databases.retrieve", {"object": "database", "data_sources": [{"id": f"ds-{m.group(1)}"}]}
+
+        m = re.fullmatch(r"/v1/data_sources/ds-([^/]+)/query", path)
+        if m and method == "POST":
+            rows = [row for row in dataset[by_database[m.group(1)]] if _matches(row, body.get("filter"))]
+            start = int(body.get("start_cursor") or 0)
+            size = int(body.get("page_size") or 100)
+            page = rows[start:start + size]
+            more = start + size < len(rows)
+            return 200, "data_sources.query", {
+                "object": "list", "results": page,
+                "has_more": more, "next_cursor": str(start + size) if more else None
+            }
+
+        if path == "/v1/pages" and method == "POST":
+            parent = body.get("parent", {}).get("database_id")
+            page = {"object": "page", "id": uuid.uuid4().hex, "last_edited_time": _edited_now(), "properties": {}}
+            if parent == database_ids["summary"]:
+                props = body.get("properties", {})
+                page["properties"] = {
+                    "币种": {"title": [{"plain_text": props["币种"]["title"][0]["text"]["content"]}]},
+                    "Global": {"relation": props.get("Global", {}).get("relation", [])}
+                }
+                with lock:
+                    dataset["summary"].append(page)
+                    pages[page["id"]] = page
+            return 200, "pages.create", page
+
+        m = re.fullmatch(r"/v1/pages/([^/]+)", path)
+        if m and method == "PATCH":
+            with lock:
+                row = pages.get(m.group(1))
+                if row is None:
+                    return 404, "pages.update", {
+                        "object": "error", "status": 404, "code": "object_not_found", "message": m.group(1)
+                    }
+                row["last_edited_time"] = _edited_now()
+            return 200, "pages.update", {"object": "page", "id": m.group(1)}
+
+        return 404, "unknown", {"object": "error", "status": 404, "code": "object_not_found", "message": path}
+
+    return route
+
+
+# 模拟的参考汇率：1 USD 可兑换的数量
+FAKE_REFERENCE_RATES = {"EUR": 0.92, "CNY": 7.1, "JPY": 150.0, "BTC": 1 / 65000, "ETH": 1 / 3200}
+
+
+def _cmc_route(method, url, body):
+    params = parse_qs(url.query)
+    if url.path.endswith("/tools/price-conversion"):
+        converts = params.get("convert", [""])[0].split(",")
+        quote = {c: {"price": FAKE_REFERENCE_RATES[c]} for c in converts if c in FAKE_REFERENCE_RATES}
+        return 200, "price-conversion", {
+            "status": {"error_code": 0, "credit_count": max(len(converts), 1)},
+            "data": {"id": 2781, "symbol": "USD", "amount": 1, "quote": quote}
+        }
+    symbols = params.get("symbol", [""])[0].split(",")
+    data = {
+        symbol: [{
+            "symbol": symbol,
+            "quote": {"USD": {"price": 1.0 + (hash(symbol) % 10000) / 100, "percent_change_24h": 0.5}}
+        }]
+        for symbol in symbols if symbol
+    }
+    return 200, "quotes/latest", {"status": {"error_code": 0, "credit_count": 1 + len(symbols) // 100}, "data": data}
+
+
+class FakeUpstreams:
+    """启动 / 关闭本地模拟的 CMC 与 Notion 服务"""
+
+    DATABASE_IDS = {"market": "market", "holdings": "holdings", "summary": "summary", "snapshot": "snapshot"}
+
+    def __init__(self, size, latency_ms=0, notion_rps=0):
+        self.stats = UpstreamStats()
+        self.dataset = build_dataset(size)
+        latency = latency_ms / 1000
+        self._servers = [
+            ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(
+                "notion", _notion_route(self.dataset, self.DATABASE_IDS), latency, self.stats, _RateWindow(notion_rps))),
+            ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(
+                "cmc", _cmc_route, latency, self.stats, None)),
+        ]
+        for server in self._servers:
+            server.daemon_threads = True
+
+    @property
+    def notion_url(self):
+        return f"http://127.0.0.1:{self._servers[0].server_address[1]}"
+
+    @property
+    def cmc_url(self):
+        return f"http://127.0.0.1:{self._servers[1].server_address[1]}"
+
+    def start(self):
+        for server in self._servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,94 @@
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+ANALYTICS_BUCKET = 300          # 对齐时间轴的桶宽（秒），与 cron 频率一致
+SECONDS_PER_YEAR = 365 * 24 * 3600
+
+
+def align_series(series, bucket=ANALYTICS_BUCKET):
+    """
+    把各 symbol 的 (ts, price, change) 序列对齐到同一时间轴
+
+    返回 (symbols, timestamps, prices)：prices 形状为 (T, S)，缺失值向前填充，
+    某 symbol 第一个点之前为 NaN
+    """
+    symbols = sorted(series)
+    columns = {symbol: np.asarray(series[symbol], dtype=np.float64) for symbol in symbols}
+
+    timestamps = np.unique(np.concatenate([
+        np.floor(col[:, 0] / bucket) * bucket for col in columns.values()
+    ])) if columns else np.empty(0)
+
+    prices = np.full((len(timestamps), len(symbols)), np.nan)
+    for j, symbol in enumerate(symbols):
+        col = columns[symbol]
+        buckets = np.floor(col[:, 0] / bucket) * bucket
+        # 每个时间点取不晚于它的最近一个报价（向前填充）
+        idx = np.searchsorted(buckets, timestamps, side="right") - 1
+        valid = idx >= 0
+        prices[valid, j] = col[idx[valid], 1]
+
+    return symbols, timestamps, prices
+
+
+def _nan_to_none(values):
+    return [None if not np.isfinite(v) else round(float(v), 8) for v in values]
+
+
+def compute_analytics(series, window=12, bucket=ANALYTICS_BUCKET):
+    """
+    向量化计算所有 symbol 的统计指标
+
+    - total_return: 区间收益率
+    - volatility: 最近 window 个对数收益率的标准差（按桶宽年化）
+    - max_drawdown: 最大回撤（负数）
+    - correlation: 对数收益率相关系数矩阵（只用所有 symbol 都有数据的时间点）
+    """
+    symbols, timestamps, prices = align_series(series, bucket)
+    if len(timestamps) < 2:
+        return {"symbols": symbols, "points": int(len(timestamps)), "metrics": {}, "correlation": None}
+
+    # 未上市前的 NaN 会触发 all-NaN / 自由度不足的 RuntimeWarning，结果按 None 处理即可
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        log_prices = np.log(prices)
+        returns = np.diff(log_prices, axis=0)                      # (T-1, S)
+
+        first_idx = np.argmax(np.isfinite(prices), axis=0)
+        first = prices[first_idx, np.arange(prices.shape[1])]
+        total_return = prices[-1] / first - 1
+
+        running_max = np.fmax.accumulate(prices, axis=0)
+        max_drawdown = np.nanmin(prices / running_max - 1, axis=0)
+
+        w = min(window, returns.shape[0])
+        recent = sliding_window_view(returns, w, axis=0)[-1]      # (S, w)
+        volatility = np.nanstd(recent, axis=-1, ddof=1) if w > 1 else np.full(len(symbols), np.nan)
+        volatility = volatility * np.sqrt(SECONDS_PER_YEAR / bucket)
+
+        complete = returns[np.all(np.isfinite(returns), axis=1)]
+        correlation = None
+        if complete.shape[0] >= 3 and len(symbols) > 1:
+            correlation = [_nan_to_none(row) for row in np.corrcoef(complete, rowvar=False)]
+
+    metrics = {
+        symbol: {
+            "last_price": None if not np.isfinite(prices[-1, j]) else float(prices[-1, j]),
+            "total_return": _nan_to_none([total_return[j]])[0],
+            "volatility": _nan_to_none([volatility[j]])[0],
+            "max_drawdown": _nan_to_none([max_drawdown[j]])[0],
+        }
+        for j, symbol in enumerate(symbols)
+    }
+
+    return {
+        "symbols": symbols,
+        "points": int(len(timestamps)),
+        "from": int(timestamps[0]),
+        "to": int(timestamps[-1]),
+        "window": w,
+        "metrics": metrics,
+        "correlation": correlation
+    }
@@ -0,0 +1,90 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUTTLCache:
+    """
+    进程内 LRU + TTL 缓存（线程安全）
+
+    - maxsize: 最大条目数，超出时淘汰最久未使用的条目
+    - ttl: 条目存活秒数
+    - sweep_interval: 主动清理过期条目的最小间隔（写入时顺带触发），避免只在读到时才清理
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, sweep_interval=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            now = time.monotonic()
+            self._data[key] = (now + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            if now - self._last_sweep >= self.sweep_interval:
+                self._sweep(now)
+
+    def _sweep(self, now):
+        expired = [key for key, (expires_at, _) in self._data.items() if now >= expires_at]
+        for key in expired:
+            del self._data[key]
+        self.expirations += len(expired)
+        self._last_sweep = now
+
+    def sweep(self):
+        """立即清理所有过期条目"""
+        with self._lock:
+            self._sweep(time.monotonic())
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations
+            }
@@ -0,0 +1,207 @@
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from lib.config import env
+from lib.metrics import bind, inc, timed
+from lib.redis import get_redis
+
+
+# 可通过环境变量 CMC_API_BASE 指向本地模拟服务（benchmark），请求时读取
+CMC_DEFAULT_API_BASE = "https://pro-api.coinmarketcap.com"
+CMC_QUOTES_PATH = "/v2/cryptocurrency/quotes/latest"
+CMC_CONVERSION_PATH = "/v2/tools/price-conversion"
+CMC_USD_ID = 2781  # CMC 中 USD（法币）的 id
+CMC_TIMEOUT = 15  # 秒
+
+# === 连接池配置 ===
+CMC_POOL_SIZE = 8
+CMC_MAX_RETRIES = 2
+
+# === 分批请求配置 ===
+CMC_CHUNK_SIZE = 100            # 每批最多 symbol 数
+CMC_CHUNK_MAX_CHARS = 1500      # 每批 symbol= 参数最大长度，避免 URL 过长
+CMC_MAX_CONCURRENCY = 4         # 并发批次数上限
+CMC_CHUNK_ATTEMPTS = 2          # 每批最多尝试次数（只重试失败的批次）
+
+# === credit 计量 ===
+CMC_CREDITS_KEY_PREFIX = "cmc_credits:"  # 按 UTC 日期计数
+CMC_CREDITS_KEY_TTL = 3 * 24 * 3600
+
+# 模块级 Session：热实例（warm invocation）之间复用 TCP/TLS 连接
+_session = None
+_session_lock = threading.Lock()
+
+
+def _cmc_url(path):
+    return env("CMC_API_BASE", CMC_DEFAULT_API_BASE) + path
+
+
+def cmc_daily_credit_cap():
+    """每日 credit 上限（环境变量 CMC_DAILY_CREDIT_CAP，0 表示不限制），每次请求时读取"""
+    return int(env("CMC_DAILY_CREDIT_CAP", "0"))
+
+
+class CMCCreditCapExceeded(requests.exceptions.RequestException):
+    """当日 CMC credit 用量已达上限"""
+
+
+def get_cmc_session():
+    """懒加载共享的 requests.Session（keep-alive 连接池 + 自动重试）"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = Retry(
+                    total=CMC_MAX_RETRIES,
+                    backoff_factor=0.5,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=("GET",),
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CMC_POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({"Accept": "application/json"})
+                _session = session
+    return _session
+
+
+def _credits_key():
+    return f"{CMC_CREDITS_KEY_PREFIX}{datetime.now(timezone.utc):%Y-%m-%d}"
+
+
+def cmc_credits_used_today():
+    """当日（UTC）已消耗的 CMC credit"""
+    redis_client = get_redis()
+    value = redis_client.get(_credits_key()) if redis_client else None
+    return int(value or 0)
+
+
+def _record_credits(cmc_data):
+    redis_client = get_redis()
+    credits = cmc_data.get("status", {}).get("credit_count") or 0
+    if redis_client and credits:
+        key = _credits_key()
+        redis_client.incrby(key, credits)
+        redis_client.expire(key, CMC_CREDITS_KEY_TTL)
+
+
+def chunk_symbols(symbols, size=CMC_CHUNK_SIZE, max_chars=CMC_CHUNK_MAX_CHARS):
+    """按数量和拼接后的长度把 symbol 切分成多批"""
+    chunks = []
+    current, length = [], 0
+    for symbol in symbols:
+        extra = len(symbol) + (1 if current else 0)
+        if current and (len(current) >= size or length + extra > max_chars):
+            chunks.append(current)
+            current, length = [], 0
+            extra = len(symbol)
+        current.append(symbol)
+        length += extra
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _cmc_get(api_key, url, params):
+    """带 credit 上限检查与埋点的 CMC GET 请求，返回 JSON"""
+    credit_cap = cmc_daily_credit_cap()
+    if credit_cap and cmc_credits_used_today() >= credit_cap:
+        raise CMCCreditCapExceeded(f"CMC 当日 credit 已达上限 {credit_cap}")
+
+    with timed("cmc"):
+        response = get_cmc_session().get(
+            url,
+            headers={"X-CMC_PRO_API_KEY": api_key},
+            params=params,
+            timeout=CMC_TIMEOUT
+        )
+    inc("upstream_calls_total", upstream="cmc", status=response.status_code)
+    # urllib3 在连接池层面做的 5xx 重试
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and retries.history:
+        inc("upstream_retries_total", len(retries.history), upstream="cmc")
+    response.raise_for_status()
+    cmc_data = response.json()
+    _record_credits(cmc_data)
+    return cmc_data
+
+
+def _fetch_chunk(api_key, symbols, convert):
+    return _cmc_get(api_key, _cmc_url(CMC_QUOTES_PATH), {
+        "symbol": ",".join(symbols),
+        "convert": convert,
+        # 无效 symbol 不让整批失败
+        "skip_invalid": "true"
+    })
+
+
+def cmc_get_quotes(api_key, symbols, convert="USD"):
+    """
+    请求 CMC v2 quotes/latest，返回合并后的 JSON（{"data": {...}, "status": {...}}）
+
+    - symbol 按数量/长度分批，批次并发请求（上限 CMC_MAX_CONCURRENCY）
+    - 只重试失败的批次；重试后仍失败的批次其 symbol 不出现在 data 中
+    - 所有批次都失败时抛出最后一个 requests.exceptions.RequestException（含 HTTPError）
+    """
+    pending = chunk_symbols(symbols)
+    failed = []
+    merged = {"data": {}, "status": {"credit_count": 0, "failed_chunks": 0}}
+    last_error = None
+
+    with ThreadPoolExecutor(max_workers=min(CMC_MAX_CONCURRENCY, len(pending) or 1)) as executor:
+        for attempt in range(CMC_CHUNK_ATTEMPTS):
+            if not pending:
+                break
+            if attempt:
+                inc("upstream_retries_total", len(pending), upstream="cmc")
+            futures = [(chunk, executor.submit(bind(_fetch_chunk), api_key, chunk, convert)) for chunk in pending]
+            pending = []
+            for chunk, future in futures:
+                try:
+                    cmc_data = future.result()
+                except CMCCreditCapExceeded as e:
+                    # 超出额度的批次不再重试
+                    last_error = e
+                    failed.append(chunk)
+                    continue
+                except requests.exceptions.RequestException as e:
+                    print(f"CMC 批次失败（第 {attempt + 1} 次，{len(chunk)} 个 symbol）:", e)
+                    last_error = e
+                    pending.append(chunk)
+                    continue
+                merged["data"].update(cmc_data.get("data", {}))
+                merged["status"]["credit_count"] += cmc_data.get("status", {}).get("credit_count") or 0
+
+    failed.extend(pending)
+    merged["status"]["failed_chunks"] = len(failed)
+    if failed and not merged["data"]:
+        raise last_error
+    return merged
+
+
+def cmc_get_reference_rates(api_key, currencies):
+    """
+    一次 price-conversion 请求换算 1 USD 到各参考货币（法币或加密货币）
+
+    返回 {currency: 1 USD 可兑换的数量}；CMC 未返回的货币不出现在结果中
+    """
+    currencies = [c for c in currencies if c != "USD"]
+    if not currencies:
+        return {}
+    cmc_data = _cmc_get(api_key, _cmc_url(CMC_CONVERSION_PATH), {
+        "amount": 1,
+        "id": CMC_USD_ID,
+        "convert": ",".join(currencies)
+    })
+    quote = cmc_data.get("data", {}).get("quote", {})
+    return {
+        currency: float(quote[currency]["price"])
+        for currency in currencies
+        if (quote.get(currency) or {}).get("price")
+    }
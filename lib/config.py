@@ -0,0 +1,29 @@
+import os
+import threading
+
+
+# === 懒加载配置：首次读取时才加载 .env，导入模块时不读取任何必填变量 ===
+_dotenv_loaded = False
+_dotenv_lock = threading.Lock()
+
+
+def _ensure_dotenv():
+    global _dotenv_loaded
+    if _dotenv_loaded:
+        return
+    with _dotenv_lock:
+        if not _dotenv_loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _dotenv_loaded = True
+
+
+def env(name, default=None):
+    """读取环境变量（首次调用时加载 .env），缺失时返回 default"""
+    _ensure_dotenv()
+    return os.environ.get(name, default)
+
+
+def missing_env(*names):
+    """返回未设置的环境变量名列表，供路由返回 500"""
+    return [name for name in names if not env(name)]
@@ -0,0 +1,400 @@
+import json
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from lib.notion import (
+    notion_iter_pages, notion_update, notion_create_account_snapshot, symbol_index_entries, symbol_index_store,
+    symbol_index_prune, symbol_index_refresh, symbol_index_is_valid, symbol_index_load, pending_holdings_filter, mark_holdings_as_error, sync_summary_for_new_holdings_rows,
+    get_holdings_sync_watermark, save_holdings_sync_watermark, HOLDINGS_ACTIVE_FILTER
+)
+from lib.prices import get_price_data
+from lib.redis import get_redis, single_flight
+from lib.write_queue import notion_enqueue_price_updates
+
+
+# === 按时间预算分段执行、可恢复的任务 ===
+JOB_KEY_PREFIX = "job:"
+JOB_CHECKPOINT_TTL = 3600    # 秒，超过后放弃未完成的任务，下次从头开始
+JOB_PRICE_CHUNK = 50         # 每段写入的 Crypto Market 页面数
+JOB_SUMMARY_CHUNK = 20       # 每段同步的 Summary (symbol, ledger) 组数
+
+
+class JobBusy(Exception):
+    """同一任务正在被另一个调用执行"""
+
+
+class BudgetedJob:
+    """
+    可恢复任务的运行状态
+
+    - state: 任务自定义的进度（游标、计数等小字段），checkpoint() 时整体写入 Redis
+    - results(name) / append(name, items): 体积随扫描增长的部分结果（行、持仓）保存在单独的 Redis list，
+      checkpoint() 时只追加新增部分，与 state 在同一事务中写入
+    - has_time(): 按已观察到的最长单段耗时预估，剩余预算不足以再跑一段时返回 False
+    - 幂等键：pending(items) / mark_done(*items) 记录本轮已完成的写入，段被重试时跳过
+    """
+
+    def __init__(self, name, scope, budget):
+        self.key = f"{JOB_KEY_PREFIX}{name}:{scope}"
+        self.started = time.monotonic()
+        self.deadline = self.started + budget
+        self._step_started = self.started
+        self._longest_step = 0.0
+        self._results = {}
+        self._unsaved = {}
+        self.has_more = True
+
+        cached = get_redis().get(self.key)
+        self.resumed = cached is not None
+        self.state = json.loads(cached) if cached else {"run_id": uuid.uuid4().hex, "started_at": time.time()}
+
+    @property
+    def done_key(self):
+        return f"{self.key}:{self.state['run_id']}:done"
+
+    def _results_key(self, name):
+        return f"{self.key}:{self.state['run_id']}:{name}"
+
+    def has_time(self):
+        return time.monotonic() + self._longest_step < self.deadline
+
+    def results(self, name):
+        """读取部分结果（首次调用时从 Redis 加载），返回的列表包含本次调用中 append 的条目"""
+        if name not in self._results:
+            # 记录用到的部分结果，finish() 时即使本次调用没有读取也能一并删除
+            if name not in self.state.setdefault("results", []):
+                self.state["results"].append(name)
+            raw = get_redis().lrange(self._results_key(name), 0, -1)
+            self._results[name] = [json.loads(item) for item in raw]
+            self._unsaved[name] = []
+        return self._results[name]
+
+    def append(self, name, items):
+        """追加部分结果；下一次 checkpoint() 时写入 Redis"""
+        items = list(items)
+        self.results(name).extend(items)
+        self._unsaved[name].extend(items)
+
+    def checkpoint(self):
+        """保存进度（state 与新增的部分结果在同一事务中写入），并记录本段耗时供 has_time 预估"""
+        now = time.monotonic()
+        self._longest_step = max(self._longest_step, now - self._step_started)
+        self._step_started = now
+
+        pipe = get_redis().pipeline(transaction=True)
+        for name, items in self._unsaved.items():
+            key = self._results_key(name)
+            if items:
+                pipe.rpush(key, *(json.dumps(item) for item in items))
+            pipe.expire(key, JOB_CHECKPOINT_TTL)
+        pipe.setex(self.key, JOB_CHECKPOINT_TTL, json.dumps(self.state))
+        pipe.execute()
+        for items in self._unsaved.values():
+            items.clear()
+
+    def finish(self):
+        self.has_more = False
+        get_redis().delete(self.key, self.done_key, *(self._results_key(name) for name in self.state.get("results", [])))
+
+    def pending(self, items):
+        """过滤掉本轮已完成的条目"""
+        items = list(items)
+        if not items:
+            return []
+        pipe = get_redis().pipeline(transaction=False)
+        for item in items:
+            pipe.sismember(self.done_key, item)
+        return [item for item, done in zip(items, pipe.execute()) if not done]
+
+    def mark_done(self, *items):
+        if items:
+            pipe = get_redis().pipeline(transaction=False)
+            pipe.sadd(self.done_key, *items)
+            pipe.expire(self.done_key, JOB_CHECKPOINT_TTL)
+            pipe.execute()
+
+    def report(self, progress):
+        return {
+            "run_id": self.state["run_id"],
+            "resumed": self.resumed,
+            "has_more": self.has_more,
+            "elapsed": round(time.monotonic() - self.started, 3),
+            "progress": progress
+        }
+
+
+@contextmanager
+def budgeted_job(name, scope, budget):
+    """
+    with budgeted_job(name, scope, budget) as job: ...
+
+    同一 (name, scope) 同一时间只允许一个调用执行，否则抛出 JobBusy
+    """
+    with single_flight(f"{JOB_KEY_PREFIX}{name}:{scope}", ttl=int(budget) + 60, wait_timeout=0) as leader:
+        if not leader:
+            raise JobBusy(f"{name} is already running")
+        yield BudgetedJob(name, scope, budget)
+
+
+def _scan(job, notion, database_id, on_rows, **query):
+    """
+    从 checkpoint 的游标继续分页读取，每页调用 on_rows(results)
+
+    返回 True 表示已读完；预算不足时保存游标并返回 False
+    """
+    if job.state.get("scan_done"):
+        return True
+    pages = notion_iter_pages(notion, database_id, start=job.state.get("position"), **query)
+    try:
+        for results, next_position in pages:
+            on_rows(results)
+            job.state["position"] = next_position
+            if next_position is None:
+                break
+            job.checkpoint()
+            if not job.has_time():
+                return False
+    finally:
+        pages.close()
+    job.state["scan_done"] = True
+    job.checkpoint()
+    return True
+
+
+def run_market_price_job(notion, api_key, database_id, symbol_property, price_field, change_field,
+                         budget, queue=False, rebuild_index=False, currency="USD", rates=None):
+    """
+    可恢复的 cron-update-cache：刷新 symbol 索引（需要重建时分页扫描）→ 分段写入价格（或入队）
+
+    - 幂等键为本轮已写入的 symbol；段被重试时不会重复写入
+    - currency 不是 USD 时按 rates（lib.rates.get_reference_rates）换算后写入
+    """
+    def prices(symbols):
+        # 写入 Notion 的价格不使用过期缓存：过期的 symbol 同步刷新
+        price_data = get_price_data(api_key, symbols, refresh_stale=True)
+        if currency == "USD":
+            return price_data
+        from lib.rates import price_data_in
+        return price_data_in(price_data, currency, rates)
+
+    with budgeted_job("cron-update-cache", database_id, budget) as job:
+        state = job.state
+        if not job.resumed:
+            state["rebuild"] = rebuild_index or not symbol_index_is_valid(database_id)
+            state["scan_started_at"] = datetime.now(timezone.utc).isoformat()
+        counts = state.setdefault("counts", {"updated": 0, "suppressed": 0, "failed": {}})
+
+        if state["rebuild"]:
+            def collect(results):
+                job.append("entries", symbol_index_entries(results, symbol_property)[0].items())
+
+            indexed = state.get("indexed") or _scan(job, notion, database_id, collect)
+            if indexed and not state.get("indexed"):
+                entries = dict(job.results("entries"))
+                symbol_index_store(database_id, entries, datetime.fromisoformat(state["scan_started_at"]))
+                state["indexed"] = True
+                job.checkpoint()
+        else:
+            if not state.get("indexed"):
+                symbol_index_prune(database_id)
+                symbol_index_refresh(notion, database_id, symbol_property)
+                state["indexed"] = True
+                job.checkpoint()
+            indexed = True
+
+        symbol_to_page = symbol_index_load(database_id) if indexed else {}
+        if indexed:
+            if not symbol_to_page:
+                job.finish()
+                raise ValueError("symbols_list is empty")
+            remaining = job.pending(sorted(symbol_to_page))
+
+            if queue:
+                counts.update(notion_enqueue_price_updates(
+                    symbol_to_page, prices(remaining), price_field, change_field))
+                remaining = []
+
+            while remaining and job.has_time():
+                chunk, remaining = remaining[:JOB_PRICE_CHUNK], remaining[JOB_PRICE_CHUNK:]
+                results = notion_update(notion, symbol_to_page, prices(chunk), price_field, change_field)
+                for symbol, result in results.items():
+                    if result["status"] == "error":
+                        counts["failed"][symbol] = result["error"]
+                    else:
+                        counts["updated" if result["status"] == "ok" else "suppressed"] += 1
+                job.mark_done(*(s for s, r in results.items() if r["status"] != "error"))
+                job.checkpoint()
+
+            if not remaining:
+                job.finish()
+
+        return {
+            **counts,
+            "job": job.report({
+                "phase": "write" if indexed else "index",
+                "scanned": len(symbol_to_page) if indexed else len(job.results("entries")),
+                "written": counts["updated"] + counts["suppressed"] + len(counts["failed"])
+            })
+        }
+
+
+def run_account_snapshot_job(notion, api_key, holdings_db_id, snapshot_db_id, snapshot_time, source,
+                             budget, refresh_positions=False, currency="USD", rates=None):
+    """
+    可恢复的账户快照：分页累加持仓（或读取持仓缓存）→ 写入一条 Snapshot
+
+    - 快照时间在首段确定；Snapshot 写入由幂等键保护，只会创建一次
+    - engine 估值的价格按 currency（Notion 中成本 / 市值的货币）换算
+    """
+    from lib.valuation import (
+        position_from_row, get_cached_positions, cache_positions, positions_price_data, value_positions
+    )
+
+    with budgeted_job("update-account-snapshot", holdings_db_id, budget) as job:
+        state = job.state
+        state.setdefault("snapshot_time", snapshot_time)
+        state.setdefault("source", source)
+        state.setdefault("scan_started_at", datetime.now(timezone.utc).isoformat())
+
+        if state["source"] == "notion":
+            totals = state.setdefault("totals", {"market_value": 0.0, "invested": 0.0, "count": 0})
+
+            def collect(results):
+                for row in results:
+                    props = row["properties"]
+                    totals["market_value"] += props["当前市值"]["formula"]["number"] or 0
+                    totals["invested"] += props["总买入成本"]["rollup"]["number"] or 0
+                    totals["count"] += 1
+        else:
+            cached = None if refresh_positions or job.resumed else get_cached_positions(notion, holdings_db_id)
+            if cached is not None:
+                # 缓存命中：不扫描，也不回写缓存（回写会重置 TTL，缓存永不过期）
+                positions = cached
+                state["scan_done"] = True
+                state["cached_positions"] = True
+            else:
+                positions = job.results("positions")
+
+            def collect(results):
+                job.append("positions", (position_from_row(row) for row in results))
+
+        summary = None
+        if _scan(job, notion, holdings_db_id, collect, filter=HOLDINGS_ACTIVE_FILTER):
+            if state["source"] == "notion":
+                summary = {
+                    "total_market_value": totals["market_value"],
+                    "total_invested": totals["invested"],
+                    "total_pnl": totals["market_value"] - totals["invested"],
+                    "asset_count": totals["count"]
+                }
+            else:
+                if not state.get("cached_positions"):
+                    cache_positions(holdings_db_id, positions, datetime.fromisoformat(state["scan_started_at"]))
+                summary = value_positions(positions, positions_price_data(api_key, positions, currency, rates))
+
+            if job.pending(["snapshot"]):
+                notion_create_account_snapshot(
+                    notion,
+                    snapshot_db_id,
+                    summary["total_market_value"],
+                    summary["total_invested"],
+                    summary["total_pnl"],
+                    summary["asset_count"],
+                    state["snapshot_time"]
+                )
+                job.mark_done("snapshot")
+            job.finish()
+
+        scanned = state["totals"]["count"] if state["source"] == "notion" else len(positions)
+        return {
+            "snapshot_time": state["snapshot_time"],
+            "summary": summary,
+            "job": job.report({"phase": "done" if summary else "scan", "scanned": scanned})
+        }
+
+
+def _summary_group_key(row):
+    """(币种, 账本) 分组键；缺字段的行各自成组，由同步逻辑标记 error"""
+    props = row.get("properties", {})
+    title_arr = props.get("币种", {}).get("title") or []
+    ledger_rel = props.get("账本", {}).get("relation") or []
+    if title_arr and ledger_rel:
+        return f"{title_arr[0]['plain_text'].strip()}|{ledger_rel[0]['id']}"
+    return f"invalid|{row.get('id')}"
+
+
+def run_summary_sync_job(notion, holdings_db_id, summary_db_id, budget, full=False, rebuild_index=False):
+    """
+    可恢复的 Summary 同步：分页筛选待同步 Holdings → 按 (币种, 账本) 组分段同步
+
+    - 幂等键为已处理的 Holdings 行 id；Summary 创建另由 Redis 去重索引保护
+    - 全部完成后才推进增量水位
+    """
+    from lib.valuation import invalidate_positions
+
+    with budgeted_job("sync-crypto-summary", holdings_db_id, budget) as job:
+        state = job.state
+        if not job.resumed:
+            state["scan_started_at"] = datetime.now(timezone.utc).isoformat()
+            state["since"] = None if full else get_holdings_sync_watermark(holdings_db_id)
+        rows = job.results("rows")
+        counts = state.setdefault("counts", {"created_count": 0, "failed_count": 0, "skipped_count": 0})
+        counts.setdefault("status_failed_count", 0)
+
+        def collect(results):
+            # 只保留同步需要的字段，控制部分结果的体积
+            job.append("rows", ({
+                "id": row["id"],
+                "properties": {name: row["properties"].get(name, {}) for name in ("币种", "账本")}
+            } for row in results))
+
+        scan_done = _scan(job, notion, holdings_db_id, collect, filter=pending_holdings_filter(state["since"]))
+
+        # 待同步的组在每次调用中只计算一次，之后在本地逐段消耗
+        groups = []
+        if scan_done:
+            pending_ids = set(job.pending(row["id"] for row in rows))
+            grouped = {}
+            for row in rows:
+                if row["id"] in pending_ids:
+                    grouped.setdefault(_summary_group_key(row), []).append(row)
+            groups = list(grouped.values())
+
+        while groups and job.has_time():
+            chunk_groups, groups = groups[:JOB_SUMMARY_CHUNK], groups[JOB_SUMMARY_CHUNK:]
+            chunk = [row for group in chunk_groups for row in group]
+            try:
+                result = sync_summary_for_new_holdings_rows(
+                    notion=notion,
+                    new_holdings_rows=chunk,
+                    SUMMARY_DB_ID=summary_db_id,
+                    rebuild_index=rebuild_index and not state.get("index_rebuilt")
+                )
+            except Exception:
+                try:
+                    mark_holdings_as_error(notion, chunk)
+                except Exception:
+                    pass
+                raise
+            state["index_rebuilt"] = True
+            for name in counts:
+                counts[name] += result[name]
+            job.mark_done(*(row["id"] for row in chunk))
+            job.checkpoint()
+
+        if scan_done and not groups:
+            # 有行的状态没写进去时不推进水位，下次增量扫描仍能看到它们
+            if not counts["status_failed_count"]:
+                save_holdings_sync_watermark(holdings_db_id, datetime.fromisoformat(state["scan_started_at"]))
+            if rows:
+                invalidate_positions(holdings_db_id)
+            job.finish()
+
+        processed = len(rows) - sum(len(group) for group in groups) if scan_done else 0
+        return {
+            **counts,
+            "processed": processed,
+            "job": job.report({"phase": "sync" if scan_done else "scan", "scanned": len(rows), "processed": processed})
+        }
@@ -0,0 +1,109 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class TokenBucket:
+    """
+    线程安全的令牌桶限流器
+
+    - rate: 每秒补充的令牌数（Notion 官方预算约 3 req/s）
+    - capacity: 桶容量，即允许的最大突发请求数
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self, tokens: float = 1):
+        """阻塞直到拿到令牌"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AIMDLimiter:
+    """
+    AIMD（加性增 / 乘性减）自适应并发控制器（线程安全）
+
+    - 每次成功：limit += increase / limit，约每完成一“轮”并发请求加 1
+    - 被限流：limit *= decrease；cooldown 秒内只减一次，避免同一波突发的多个 429 连续减半
+    - pause(seconds)：在此之前所有调用方都不发新请求（对应 Retry-After）
+    """
+
+    def __init__(self, initial: float, minimum: float = 1, maximum: float = None,
+                 increase: float = 1.0, decrease: float = 0.5, cooldown: float = 1.0):
+        self.minimum = float(minimum)
+        self.maximum = float(maximum if maximum is not None else initial)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self):
+        """阻塞直到有空闲的并发槽（且不在暂停期内）"""
+        with self._cond:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                if self._in_flight < max(int(self._limit), 1):
+                    self._in_flight += 1
+                    return
+                self._cond.wait()
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def on_success(self):
+        with self._cond:
+            if self._limit < self.maximum:
+                self._limit = min(self.maximum, self._limit + self.increase / self._limit)
+                self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self._limit = max(self.minimum, self._limit * self.decrease)
+                self._last_decrease = now
+
+    def pause(self, seconds: float):
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
@@ -0,0 +1,193 @@
+import time
+import threading
+import contextvars
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import g, request
+
+
+# === 轻量级进程内指标（Prometheus 文本格式导出）===
+METRIC_PREFIX = "crypto_api_"
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_counters = defaultdict(float)   # (name, labels) -> value
+_histograms = {}                 # (name, labels) -> [bucket_counts, sum, count]
+
+# 当前请求的分阶段耗时 {stage: [总秒数, 次数]}，用于 Server-Timing 响应头
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """计数器累加"""
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] += amount
+
+
+def observe(name, seconds, **labels):
+    """直方图记录一次观测值"""
+    key = (name, _labels(labels))
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0]
+        index = bisect_left(HISTOGRAM_BUCKETS, seconds)
+        if index < len(HISTOGRAM_BUCKETS):
+            hist[0][index] += 1
+        hist[1] += seconds
+        hist[2] += 1
+
+
+@contextmanager
+def timed(stage, **labels):
+    """
+    记录一个上游阶段（redis / cmc / notion）的耗时与调用次数
+
+    同时累加到当前请求的 Server-Timing
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe("stage_duration_seconds", elapsed, stage=stage, **labels)
+        timings = _request_timings.get()
+        if timings is not None:
+            with _lock:
+                entry = timings.setdefault(stage, [0.0, 0])
+                entry[0] += elapsed
+                entry[1] += 1
+
+
+def bind(fn):
+    """
+    绑定当前上下文，供线程池任务使用（线程池默认不继承 contextvars）
+
+    每次调用单独复制一份 context，同一个 Context 不能被多个线程同时进入
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def register_request_metrics(app):
+    """请求级埋点：记录接口耗时并写入 Server-Timing 响应头"""
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_token = _request_timings.set({})
+
+    @app.after_request
+    def finish_request_timer(response):
+        started = g.pop("metrics_started", None)
+        token = g.pop("metrics_token", None)
+        if started is None:
+            return response
+
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or "unknown"
+        observe("request_duration_seconds", elapsed, endpoint=endpoint)
+        inc("requests_total", endpoint=endpoint, status=response.status_code)
+
+        timings = _request_timings.get() or {}
+        parts = [
+            f'{stage};dur={total * 1000:.1f};desc="{count} calls"'
+            for stage, (total, count) in sorted(timings.items())
+        ]
+        parts.append(f"total;dur={elapsed * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(parts)
+
+        if token is not None:
+            _request_timings.reset(token)
+        return response
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def render_prometheus(gauges=None):
+    """
+    导出 Prometheus 文本格式
+
+    :param gauges: {name: value} 或 {name: [(labels_dict, value), ...]}，抓取时才计算的瞬时值
+    """
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in _histograms.items())
+
+    seen = set()
+    for (name, labels), value in counters:
+        metric = f"{METRIC_PREFIX}{name}"
+        if metric not in seen:
+            lines.append(f"# TYPE {metric} counter")
+            seen.add(metric)
+        lines.append(f"{metric}{_format_labels(labels)} {value:g}")
+
+    for (name, labels), (buckets, total, count) in histograms:
+        metric = f"{METRIC_PREFIX}{name}"
+        if metric not in seen:
+            lines.append(f"# TYPE {metric} histogram")
+            seen.add(metric)
+        cumulative = 0
+        for bound, bucket_count in zip(HISTOGRAM_BUCKETS, buckets):
+            cumulative += bucket_count
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+        lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {total:.6f}")
+        lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+
+    for name, value in (gauges or {}).items():
+        metric = f"{METRIC_PREFIX}{name}"
+        lines.append(f"# TYPE {metric} gauge")
+        samples = value if isinstance(value, list) else [({}, value)]
+        for labels, sample in samples:
+            lines.append(f"{metric}{_format_labels(_labels(labels))} {sample:g}")
+
+    return "\n".join(lines) + "\n"
+
+
+class InstrumentedRedis:
+    """
+    Redis 客户端代理：每个命令 / pipeline.execute 计入 redis 阶段耗时
+
+    非可调用属性原样透传（如 FakeRedis.is_local）
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name == "pipeline":
+            return lambda *args, **kwargs: _InstrumentedPipeline(attr(*args, **kwargs))
+        if name == "pubsub" or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with timed("redis"):
+                return attr(*args, **kwargs)
+        return call
+
+
+class _InstrumentedPipeline:
+    def __init__(self, pipe):
+        self._pipe = pipe
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+    def execute(self, *args, **kwargs):
+        with timed("redis"):
+            return self._pipe.execute(*args, **kwargs)
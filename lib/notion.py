@@ -1,95 +1,650 @@
-from datetime import datetime
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+import json
 import time
-from notion_client import Client
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 from flask import jsonify
 
+from lib.config import env
+from lib.limiter import AIMDLimiter, TokenBucket
+from lib.metrics import bind, inc, timed
+from lib.redis import get_redis
+
+# notion_client / httpx 在首次创建客户端时才导入，缩短冷启动
+if TYPE_CHECKING:
+    from notion_client import Client
+
+# === Notion 并发写入配置 ===
+NOTION_MAX_WORKERS = 4          # 初始并发数（AIMD 起点）
+NOTION_MAX_CONCURRENCY = NOTION_MAX_WORKERS * 2  # AIMD 并发上限，也是线程池大小
+NOTION_DEFAULT_REQUESTS_PER_SECOND = 3  # Notion 官方平均速率预算 ~3 req/s，可用环境变量 NOTION_REQUESTS_PER_SECOND 覆盖
+
+# 所有写请求共享同一个令牌桶，保证整体速率不超预算；首次使用时按配置创建
+_notion_rate_limiter = None
+_notion_rate_limiter_lock = threading.Lock()
+
+# 所有 Notion HTTP 请求共享的自适应并发：429 时减半，持续成功时逐步加回
+notion_concurrency = AIMDLimiter(initial=NOTION_MAX_WORKERS, minimum=1, maximum=NOTION_MAX_CONCURRENCY)
+
+# === 429 / 5xx 重试配置 ===
+NOTION_MAX_ATTEMPTS = 5
+NOTION_BACKOFF_BASE = 0.5   # 秒，指数退避基数（full jitter）
+NOTION_BACKOFF_MAX = 30     # 秒，单次等待上限
+
+
+# === 共享 Notion 客户端（热实例复用连接池）===
+NOTION_MAX_CONNECTIONS = NOTION_MAX_CONCURRENCY
+NOTION_MAX_KEEPALIVE = NOTION_MAX_WORKERS
+NOTION_KEEPALIVE_EXPIRY = 60
+NOTION_TIMEOUT_MS = 30_000
+NOTION_DEFAULT_BASE_URL = "https://api.notion.com"  # 可用环境变量 NOTION_BASE_URL 指向本地模拟服务
+
+_notion_clients = {}
+_notion_clients_lock = threading.Lock()
+
+
+def get_notion_rate_limiter():
+    """共享令牌桶（懒创建：速率在首次使用时读取，.env 中的 NOTION_REQUESTS_PER_SECOND 同样生效）"""
+    global _notion_rate_limiter
+    if _notion_rate_limiter is None:
+        with _notion_rate_limiter_lock:
+            if _notion_rate_limiter is None:
+                rate = float(env("NOTION_REQUESTS_PER_SECOND", NOTION_DEFAULT_REQUESTS_PER_SECOND))
+                _notion_rate_limiter = TokenBucket(rate=rate)
+    return _notion_rate_limiter
+
+
+def _create_http_client():
+    """带连接池上限的 httpx 客户端，在传输层统计每个 Notion 请求的耗时与状态码（覆盖所有 SDK 调用）"""
+    import httpx
+
+    class InstrumentedTransport(httpx.HTTPTransport):
+        def handle_request(self, request):
+            with timed("notion"):
+                response = super().handle_request(request)
+                # 响应体在传输层返回后才被读取；在此读完，耗时才包含完整的响应时间
+                response.read()
+            inc("upstream_calls_total", upstream="notion", status=response.status_code)
+            return response
+
+    limits = httpx.Limits(
+        max_connections=NOTION_MAX_CONNECTIONS,
+        max_keepalive_connections=NOTION_MAX_KEEPALIVE,
+        keepalive_expiry=NOTION_KEEPALIVE_EXPIRY,
+    )
+    return httpx.Client(transport=InstrumentedTransport(limits=limits))
+
+
+def _retry_after_seconds(error):
+    """解析 Retry-After（秒数或 HTTP 日期），缺失或无法解析时返回 None"""
+    value = (getattr(error, "headers", None) or {}).get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max((retry_at - datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def notion_call(fn, *args, idempotent=True, **kwargs):
+    """
+    共享的 Notion 调用包装：AIMD 并发槽 + 429 / 5xx 重试
 
-symbol_to_page = {}
+    - 429：通知 AIMD 降低并发；按 Retry-After 暂停所有调用方后重试
+    - 503 与 429 一样表示请求未被处理，任何请求都可重试
+    - 500 / 502 / 504 / 超时：结果不确定，只重试幂等请求（创建页面不重试，避免重复）
+    - 没有 Retry-After 时使用 full jitter 指数退避；重试同样消耗令牌桶
+    """
+    from notion_client.errors import HTTPResponseError, RequestTimeoutError
 
+    for attempt in range(NOTION_MAX_ATTEMPTS):
+        if attempt:
+            get_notion_rate_limiter().acquire()
+        with notion_concurrency.slot():
+            try:
+                result = fn(*args, **kwargs)
+            except (HTTPResponseError, RequestTimeoutError) as e:
+                status = getattr(e, "status", None)
+                if status == 429:
+                    notion_concurrency.on_throttle()
+                retryable = status in (429, 503) or (
+                    idempotent and (status in (500, 502, 504) or isinstance(e, RequestTimeoutError))
+                )
+                if not retryable or attempt == NOTION_MAX_ATTEMPTS - 1:
+                    raise
+                retry_after = _retry_after_seconds(e) if status in (429, 503) else None
+            else:
+                notion_concurrency.on_success()
+                return result
+
+        if retry_after is not None:
+            notion_concurrency.pause(retry_after)
+            delay = retry_after + random.uniform(0, NOTION_BACKOFF_BASE)
+        else:
+            delay = random.uniform(0, min(NOTION_BACKOFF_MAX, NOTION_BACKOFF_BASE * 2 ** attempt))
+        inc("upstream_retries_total", upstream="notion")
+        print(f"Notion 请求失败（{status or '超时'}），{delay:.2f}s 后第 {attempt + 2} 次尝试")
+        time.sleep(delay)
+
+
+def get_notion_client(token):
+    """
+    懒加载并复用 Notion Client（按 token 缓存，底层 httpx 连接池线程安全）
 
-def notion_get(notion, NOTION_DATABASE_ID, NOTION_SYMBOL_PROPERTY_NAME):
+    每个 SDK 请求都经过 notion_call（自适应并发 + 429 / 5xx 重试）
     """
-    Crypto Market 数据库 读取方法
+    client = _notion_clients.get(token)
+    if client is None:
+        with _notion_clients_lock:
+            client = _notion_clients.get(token)
+            if client is None:
+                from notion_client import Client
+
+                class RetryingClient(Client):
+                    def request(self, path, method, query=None, body=None, form_data=None, auth=None):
+                        # 查询虽是 POST 但不修改数据；创建页面（POST /pages）不是幂等请求
+                        idempotent = method.upper() != "POST" or path.rstrip("/").endswith("/query")
+                        return notion_call(super().request, path, method, query, body, form_data, auth,
+                                           idempotent=idempotent)
+
+                client = RetryingClient(client=_create_http_client(), auth=token, timeout_ms=NOTION_TIMEOUT_MS,
+                                        base_url=env("NOTION_BASE_URL", NOTION_DEFAULT_BASE_URL))
+                _notion_clients[token] = client
+    return client
+
+
+def notion_run_concurrent(tasks: dict, max_workers: int = NOTION_MAX_CONCURRENCY, rate_limited: bool = True):
     """
-    db_response = notion.databases.retrieve(database_id=NOTION_DATABASE_ID)
-    data_sources = db_response.get("data_sources", [])  # 列表，可能多个
-    if data_sources:
-        data_source_id = data_sources[0]["id"]  # 假设用第一个源；多源时需循环或指定
-    else:
-        raise ValueError("No data sources found!")
+    有界线程池 + 共享令牌桶执行 Notion 请求
 
-    response = notion.data_sources.query(
-            **{
-                "data_source_id": data_source_id,
-            }
-        )
-    symbols_list = []
+    线程池大小为并发上限；实际同时在途的请求数由 notion_concurrency（AIMD）按 429 反馈动态调整
 
-    for result in response['results']:
+    :param tasks: {key: 无参可调用对象}
+    :param rate_limited: 每个任务执行前取一个令牌；任务内部发起多个请求时传 False，由任务自行 acquire
+    :return: {key: {"status": "ok"} | {"status": "error", "error": str, "code": Notion 错误码或 None}}
+    """
+    def run(task):
+        if rate_limited:
+            get_notion_rate_limiter().acquire()
         try:
-            # 尝试获取 Symbol 属性的内容
-            symbol_prop = result['properties'][NOTION_SYMBOL_PROPERTY_NAME]
-            # 假设 Symbol 是 Rich Text 类型，提取纯文本并格式化
-            symbol = symbol_prop['rich_text'][0]['plain_text'].strip().upper()
-            if symbol:
-                symbol_to_page[symbol] = result['id']
-                symbols_list.append(symbol)
-        except (KeyError, IndexError):
-            # 忽略不符合预期结构的页面
-            continue
+            task()
+            return {"status": "ok"}
+        except Exception as e:
+            return {"status": "error", "error": str(e), "code": getattr(e, "code", None)}
+
+    if not tasks:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+        futures = {key: executor.submit(bind(run), task) for key, task in tasks.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+
+def notion_update_pages(notion, updates: dict, max_workers: int = NOTION_MAX_CONCURRENCY):
+    """
+    并发更新多个页面
+
+    :param updates: {key: (page_id, properties)}
+    :return: {key: 执行结果}，格式同 notion_run_concurrent；页面已删除 / 归档时额外带 "removed": True
+    """
+    tasks = {
+        key: (lambda page_id=page_id, properties=properties:
+              notion.pages.update(page_id=page_id, properties=properties))
+        for key, (page_id, properties) in updates.items()
+    }
+    results = notion_run_concurrent(tasks, max_workers)
+
+    removed = []
+    for key, result in results.items():
+        if _page_removed(result):
+            result["removed"] = True
+            removed.append(updates[key][0])
+    notion_record_removed(removed)
+    return results
+
+
+def _page_removed(result):
+    """更新失败是否因为页面已删除（object_not_found）或已归档（validation_error: archived）"""
+    code = result.get("code")
+    return code == "object_not_found" or (code == "validation_error" and "archived" in result.get("error", ""))
+
+
+NOTION_PAGE_SIZE = 100  # data_sources.query 单页最大条数
+
+
+# === database → data source 解析缓存 ===
+DATABASE_META_TTL = 6 * 3600              # 元数据的有效期（Redis 与进程内缓存都按 fetched_at 计算）
+DATABASE_META_KEY_PREFIX = "notion_meta:"
+
+# 进程内缓存：热实例直接命中，不访问 Redis / Notion
+_database_meta = {}
+_database_meta_lock = threading.Lock()
+
+
+def _database_meta_fresh(meta):
+    return meta is not None and time.time() - meta.get("fetched_at", 0) < DATABASE_META_TTL
+
+
+def notion_resolve_database(notion, database_id):
+    """
+    解析数据库的 data source id
+
+    查找顺序：进程内 map → Redis → Notion databases.retrieve，均在 DATABASE_META_TTL 后过期，
+    数据库新增的 data source 最迟在一个 TTL 后生效
+    返回 {"data_source_ids": [...], "fetched_at": 时间戳}
+    """
+    meta = _database_meta.get(database_id)
+    if _database_meta_fresh(meta):
+        return meta
+
+    redis_client = get_redis()
+    key = f"{DATABASE_META_KEY_PREFIX}{database_id}"
+    cached = redis_client.get(key) if redis_client else None
+    meta = json.loads(cached) if cached else None
+    if not _database_meta_fresh(meta):
+        db_response = notion.databases.retrieve(database_id=database_id)
+        data_sources = db_response.get("data_sources", [])  # 列表，可能多个
+        if not data_sources:
+            raise ValueError(f"No data sources found in database {database_id}")
+
+        meta = {"data_source_ids": [ds["id"] for ds in data_sources], "fetched_at": time.time()}
+        if redis_client:
+            redis_client.setex(key, DATABASE_META_TTL, json.dumps(meta))
+
+    with _database_meta_lock:
+        _database_meta[database_id] = meta
+    return meta
+
+
+def notion_invalidate_database(database_id):
+    """清除某个数据库的解析缓存（进程内 + Redis）"""
+    redis_client = get_redis()
+    with _database_meta_lock:
+        _database_meta.pop(database_id, None)
+    if redis_client:
+        redis_client.delete(f"{DATABASE_META_KEY_PREFIX}{database_id}")
+
+
+def notion_get_data_source_ids(notion, database_id):
+    """读取数据库下所有 data source 的 id（走解析缓存）"""
+    return notion_resolve_database(notion, database_id)["data_source_ids"]
+
+
+def notion_iter_pages(notion, database_id, start=None, page_size=NOTION_PAGE_SIZE, **query):
+    """
+    按页读取数据库所有 data source（按 has_more / next_cursor 翻页）
+
+    - 逐页产出 (results, next_position)；next_position 为 [data source 序号, cursor]，读完时为 None
+    - start: 上次保存的 next_position，从该位置继续读取（可恢复任务使用）
+    - 处理当前页时，后台线程已在预取下一页
+    - query: 透传给 data_sources.query 的 filter / sorts 等参数
+    """
+    def fetch(data_source_id, cursor):
+        kwargs = dict(query, data_source_id=data_source_id, page_size=page_size)
+        if cursor:
+            kwargs["start_cursor"] = cursor
+        from notion_client import APIResponseError
+        from notion_client.errors import APIErrorCode
+        try:
+            return notion.data_sources.query(**kwargs)
+        except APIResponseError as e:
+            # data source 被删除 / 取消共享：缓存的 id 已失效
+            if e.code == APIErrorCode.ObjectNotFound:
+                notion_invalidate_database(database_id)
+            raise
+
+    fetch = bind(fetch)
+    start_index, start_cursor = start or (0, None)
+    data_source_ids = notion_get_data_source_ids(notion, database_id)
+
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        for index in range(start_index, len(data_source_ids)):
+            data_source_id = data_source_ids[index]
+            pending = prefetcher.submit(fetch, data_source_id, start_cursor if index == start_index else None)
+            while pending is not None:
+                response = pending.result()
+                pending = None
+                if response.get("has_more") and response.get("next_cursor"):
+                    pending = prefetcher.submit(fetch, data_source_id, response["next_cursor"])
+                    next_position = [index, response["next_cursor"]]
+                elif index + 1 < len(data_source_ids):
+                    next_position = [index + 1, None]
+                else:
+                    next_position = None
+                yield response["results"], next_position
+
+
+def notion_edited_since(notion, database_id, since: datetime):
+    """
+    数据库中是否有在 since 之后修改过的页面（每个 data source 一次 page_size=1 的筛选查询）
+
+    since 按 last_edited_time 的分钟精度取整并留出安全余量，可能多报、不会漏报
+    """
+    query_filter = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": _watermark(since)}}
+    for data_source_id in notion_get_data_source_ids(notion, database_id):
+        response = notion.data_sources.query(data_source_id=data_source_id, filter=query_filter, page_size=1)
+        if response.get("results"):
+            return True
+    return False
+
+
+def notion_iter_rows(notion, database_id, page_size=NOTION_PAGE_SIZE, **query):
+    """
+    流式读取数据库所有 data source 的行
+
+    - 任意时刻最多持有两页数据，内存占用与数据库大小无关
+    - query: 透传给 data_sources.query 的 filter / sorts 等参数
+    """
+    for results, _ in notion_iter_pages(notion, database_id, page_size=page_size, **query):
+        yield from results
+
 
-    if not symbols_list:
+def notion_market_symbol(row, NOTION_SYMBOL_PROPERTY_NAME):
+    """Crypto Market 行的 Symbol（Rich Text，去空格并大写）；结构不符合预期时返回 None"""
+    try:
+        symbol_prop = row['properties'][NOTION_SYMBOL_PROPERTY_NAME]
+        return symbol_prop['rich_text'][0]['plain_text'].strip().upper() or None
+    except (KeyError, IndexError):
+        return None
+
+
+# === Crypto Market symbol → page_id 持久索引（Redis hash）===
+# hash:      page_id -> symbol（以 page_id 为键，页面改名 / 清空 Symbol 时可直接覆盖或删除）
+# count:     期望成员数，用于校验 hash 是否被淘汰 / 损坏
+# hwm:       上次刷新的 last_edited_time 水位，刷新时只查询之后修改过的页面
+# refreshed: 最近一次增量刷新的标记（SET NX EX），间隔内不再查询 Notion
+SYMBOL_INDEX_KEY_PREFIX = "notion_symbol_index:"
+# 价格写入也会更新页面的 last_edited_time，每次 cron 都增量刷新会把刚写过的页面全部读回来，
+# 因此增量刷新按固定间隔执行；已删除 / 归档的页面由更新失败记录，每次都剔除
+SYMBOL_INDEX_REFRESH_INTERVAL = 600  # 秒
+# set：更新时发现已删除 / 归档的页面（page_id 全局唯一，不区分数据库）
+NOTION_REMOVED_PAGES_KEY = "notion_removed_pages"
+NOTION_REMOVED_PAGES_TTL = 24 * 3600
+
+
+def _symbol_index_keys(NOTION_DATABASE_ID):
+    key = f"{SYMBOL_INDEX_KEY_PREFIX}{NOTION_DATABASE_ID}"
+    return key, f"{key}:count", f"{key}:hwm"
+
+
+def symbol_index_entries(rows, NOTION_SYMBOL_PROPERTY_NAME):
+    """
+    Crypto Market 行 → (有效页面 {page_id: symbol}, 应从索引移除的 page_id 列表)
+
+    已归档 / 在回收站或 Symbol 为空的页面视为移除
+    """
+    live, gone = {}, []
+    for row in rows:
+        symbol = notion_market_symbol(row, NOTION_SYMBOL_PROPERTY_NAME)
+        if symbol and not (row.get("in_trash") or row.get("archived")):
+            live[row["id"]] = symbol
+        else:
+            gone.append(row["id"])
+    return live, gone
+
+
+def _symbol_index_apply(NOTION_DATABASE_ID, live: dict, gone, watermark: str = None):
+    """写入变更 / 删除移除的页面，并更新成员数（与水位）；返回移除数"""
+    redis_client = get_redis()
+    key, count_key, hwm_key = _symbol_index_keys(NOTION_DATABASE_ID)
+
+    pipe = redis_client.pipeline(transaction=True)
+    if live:
+        pipe.hset(key, mapping=live)
+    if gone:
+        pipe.hdel(key, *gone)
+    pipe.hlen(key)
+    results = pipe.execute()
+
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.set(count_key, results[-1])
+    if watermark:
+        pipe.set(hwm_key, watermark)
+    pipe.execute()
+    return results[-2] if gone else 0
+
+
+def symbol_index_store(NOTION_DATABASE_ID, live: dict, scan_started_at: datetime):
+    """
+    全量写入索引：先写临时 key，完成后 RENAME 原子替换，再记录成员数与水位
+
+    :param live: {page_id: symbol}，全量扫描的结果
+    """
+    redis_client = get_redis()
+    key, count_key, hwm_key = _symbol_index_keys(NOTION_DATABASE_ID)
+    building_key = f"{key}:building"
+
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(building_key)
+    if live:
+        pipe.hset(building_key, mapping=live)
+        pipe.rename(building_key, key)
+    else:
+        pipe.delete(key)
+    pipe.set(count_key, len(live))
+    pipe.set(hwm_key, _watermark(scan_started_at))
+    pipe.setex(f"{key}:refreshed", SYMBOL_INDEX_REFRESH_INTERVAL, 1)
+    pipe.execute()
+
+    print(f"Symbol 索引已重建: {len(live)} 条")
+
+
+def symbol_index_rebuild(notion, NOTION_DATABASE_ID, NOTION_SYMBOL_PROPERTY_NAME):
+    """全量扫描 Crypto Market 重建索引"""
+    scan_started_at = datetime.now(timezone.utc)
+    live, _ = symbol_index_entries(notion_iter_rows(notion, NOTION_DATABASE_ID), NOTION_SYMBOL_PROPERTY_NAME)
+    symbol_index_store(NOTION_DATABASE_ID, live, scan_started_at)
+
+
+def symbol_index_refresh(notion, NOTION_DATABASE_ID, NOTION_SYMBOL_PROPERTY_NAME, force=False):
+    """
+    增量刷新：只查询水位之后修改过的页面（距上次刷新不足 SYMBOL_INDEX_REFRESH_INTERVAL 时跳过）
+
+    返回 {"changed": 新增 / 修改数, "removed": 移除数}；跳过时返回 None
+    """
+    redis_client = get_redis()
+    key, _, hwm_key = _symbol_index_keys(NOTION_DATABASE_ID)
+    if not redis_client.set(f"{key}:refreshed", 1, nx=not force, ex=SYMBOL_INDEX_REFRESH_INTERVAL):
+        return None
+
+    scan_started_at = datetime.now(timezone.utc)
+    rows = notion_iter_rows(notion, NOTION_DATABASE_ID, filter={
+        "timestamp": "last_edited_time",
+        "last_edited_time": {"on_or_after": redis_client.get(hwm_key)}
+    })
+    live, gone = symbol_index_entries(rows, NOTION_SYMBOL_PROPERTY_NAME)
+    removed = _symbol_index_apply(NOTION_DATABASE_ID, live, gone, _watermark(scan_started_at))
+
+    if live or removed:
+        print(f"Symbol 索引增量刷新: {len(live)} 条变更, {removed} 条移除")
+    return {"changed": len(live), "removed": removed}
+
+
+def symbol_index_prune(NOTION_DATABASE_ID):
+    """剔除更新时发现已删除 / 归档的页面（不访问 Notion）；返回移除数"""
+    redis_client = get_redis()
+    removed_pages = list(redis_client.smembers(NOTION_REMOVED_PAGES_KEY))
+    if not removed_pages:
+        return 0
+    removed = _symbol_index_apply(NOTION_DATABASE_ID, {}, removed_pages)
+    redis_client.srem(NOTION_REMOVED_PAGES_KEY, *removed_pages)
+    if removed:
+        print(f"Symbol 索引移除已删除 / 归档的页面: {removed} 条")
+    return removed
+
+
+def symbol_index_is_valid(NOTION_DATABASE_ID):
+    """索引已建立（有水位）且成员数与记录一致"""
+    redis_client = get_redis()
+    key, count_key, hwm_key = _symbol_index_keys(NOTION_DATABASE_ID)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get(count_key)
+    pipe.get(hwm_key)
+    pipe.hlen(key)
+    expected, hwm, total = pipe.execute()
+    return hwm is not None and expected is not None and total == int(expected)
+
+
+def symbol_index_load(NOTION_DATABASE_ID):
+    """读取索引，返回 {symbol: page_id}"""
+    key, _, _ = _symbol_index_keys(NOTION_DATABASE_ID)
+    return {symbol: page_id for page_id, symbol in get_redis().hgetall(key).items()}
+
+
+def notion_record_removed(page_ids):
+    """记录已删除 / 归档的页面，下次读取索引时剔除"""
+    redis_client = get_redis()
+    if redis_client and page_ids:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.sadd(NOTION_REMOVED_PAGES_KEY, *page_ids)
+        pipe.expire(NOTION_REMOVED_PAGES_KEY, NOTION_REMOVED_PAGES_TTL)
+        pipe.execute()
+
+
+def notion_sync_symbol_index(notion, NOTION_DATABASE_ID, NOTION_SYMBOL_PROPERTY_NAME, rebuild=False):
+    """
+    维护持久索引：索引缺失 / 损坏或 rebuild=True 时全量重建，否则剔除已移除页面并按间隔增量刷新
+    """
+    if rebuild or not symbol_index_is_valid(NOTION_DATABASE_ID):
+        symbol_index_rebuild(notion, NOTION_DATABASE_ID, NOTION_SYMBOL_PROPERTY_NAME)
+    else:
+        symbol_index_prune(NOTION_DATABASE_ID)
+        symbol_index_refresh(notion, NOTION_DATABASE_ID, NOTION_SYMBOL_PROPERTY_NAME)
+
+
+def notion_get(notion, NOTION_DATABASE_ID, NOTION_SYMBOL_PROPERTY_NAME, rebuild=False):
+    """
+    Crypto Market 数据库 读取方法，返回 {symbol: page_id}
+
+    - 有 Redis：读取持久索引（见 notion_sync_symbol_index），大多数调用不需要读取整个数据库
+    - 没有 Redis：每次全量读取
+    """
+    if get_redis():
+        notion_sync_symbol_index(notion, NOTION_DATABASE_ID, NOTION_SYMBOL_PROPERTY_NAME, rebuild=rebuild)
+        symbol_to_page = symbol_index_load(NOTION_DATABASE_ID)
+    else:
+        live, _ = symbol_index_entries(notion_iter_rows(notion, NOTION_DATABASE_ID), NOTION_SYMBOL_PROPERTY_NAME)
+        symbol_to_page = {symbol: page_id for page_id, symbol in live.items()}
+
+    if not symbol_to_page:
         raise ValueError("symbols_list is empty")
-    
-    return symbols_list
 
-def notion_update(notion, price_data, PRICE_FIELD, CHANGE_FIELD):
+    return symbol_to_page
+
+
+# === 写入抑制：价格变化不足 epsilon 时跳过 Notion 更新 ===
+NOTION_DEFAULT_WRITE_EPSILON = 0.001  # 相对变化阈值，可用环境变量 NOTION_WRITE_EPSILON 覆盖
+NOTION_LAST_WRITTEN_KEY = "notion_last_written"  # hash: page_id -> 上次写入的 {"price", "change_24h"}
+
+
+def notion_write_epsilon():
+    """写入抑制阈值（每次调用时读取 NOTION_WRITE_EPSILON）"""
+    return float(env("NOTION_WRITE_EPSILON", NOTION_DEFAULT_WRITE_EPSILON))
+
+
+def _materially_changed(old, new, epsilon, floor=0.0):
+    """相对变化是否超过 epsilon；floor 防止接近 0 的值（如涨跌幅）被放大"""
+    return abs(new - old) > epsilon * max(abs(old), abs(new), floor)
+
+
+def notion_plan_updates(symbol_to_page, price_data, PRICE_FIELD, CHANGE_FIELD, epsilon=None):
     """
-    Crypto Market 数据库 更新方法
+    根据 symbol_to_page（notion_get 的返回值）与上次写入值（Redis）生成需要写入的页面
+
+    与上次写入值相比变化不足 epsilon 的页面标记为 suppressed
+    返回 (updates, suppressed)：
+    - updates: {symbol: (page_id, properties, {"price", "change_24h"})}
+    - suppressed: {symbol: page_id}
     """
-    updated_count = 0
+    if epsilon is None:
+        epsilon = notion_write_epsilon()
+    redis_client = get_redis()
+    candidates = {
+        symbol: (page_id, price_data[symbol])
+        for symbol, page_id in symbol_to_page.items()
+        if price_data.get(symbol)
+    }
 
-    for symbol, page_id in symbol_to_page.items():
-        info = price_data.get(symbol)
+    page_ids = [page_id for page_id, _ in candidates.values()]
+    last_written = redis_client.hmget(NOTION_LAST_WRITTEN_KEY, page_ids) if redis_client and page_ids else []
+    last_written = dict(zip(page_ids, last_written))
 
-        if not info:
-            continue
+    updates = {}
+    suppressed = {}
 
-        notion.pages.update(
-            page_id=page_id,
-            properties={
-                PRICE_FIELD: {"number": info["price"]},
-                CHANGE_FIELD: {"number": info["change_24h"]},
-            }
-        )
-        updated_count += 1
+    for symbol, (page_id, info) in candidates.items():
+        last = last_written.get(page_id)
+        if last:
+            last = json.loads(last)
+            if not (_materially_changed(last["price"], info["price"], epsilon)
+                    or _materially_changed(last["change_24h"], info["change_24h"], epsilon, floor=1.0)):
+                suppressed[symbol] = page_id
+                continue
 
-    return updated_count
+        updates[symbol] = (page_id, {
+            PRICE_FIELD: {"number": info["price"]},
+            CHANGE_FIELD: {"number": info["change_24h"]},
+        }, {"price": info["price"], "change_24h": info["change_24h"]})
 
+    return updates, suppressed
 
-def notion_get_holdings_rows(notion, HOLDINGS_DATABASE_ID):
+
+def notion_record_written(written: dict):
+    """记录成功写入的值，供下次比较；written: {page_id: {"price", "change_24h"}}"""
+    redis_client = get_redis()
+    if redis_client and written:
+        redis_client.hset(NOTION_LAST_WRITTEN_KEY, mapping={
+            page_id: json.dumps(value) for page_id, value in written.items()
+        })
+
+
+def notion_update(notion, symbol_to_page, price_data, PRICE_FIELD, CHANGE_FIELD, epsilon=None):
     """
-    Holdings 数据库
-    【账户聚合读取】方法
-    当前有效持仓的所有行
+    Crypto Market 数据库 更新方法
+
+    - 与上次写入值（Redis）相比变化不足 epsilon 的页面直接跳过
+    - 返回 {symbol: {"status": "ok" | "suppressed"} | {"status": "error", "error": str, ...}}
     """
-    db_response = notion.databases.retrieve(database_id=HOLDINGS_DATABASE_ID)
-    data_sources = db_response.get("data_sources", [])
+    updates, suppressed = notion_plan_updates(symbol_to_page, price_data, PRICE_FIELD, CHANGE_FIELD, epsilon)
+    results = {symbol: {"status": "suppressed"} for symbol in suppressed}
 
-    if not data_sources:
-        raise ValueError("No data sources found!")
+    results.update(notion_update_pages(notion, {
+        symbol: (page_id, properties) for symbol, (page_id, properties, _) in updates.items()
+    }))
 
-    data_source_id = data_sources[0]["id"]
+    notion_record_written({
+        page_id: value
+        for symbol, (page_id, _, value) in updates.items()
+        if results[symbol]["status"] == "ok"
+    })
+
+    return results
 
-    response = notion.data_sources.query(
-        data_source_id=data_source_id,
-        filter={
-            "property": "当前持仓数量",
-            "number": {"greater_than": 0}
-        }
-    )
 
-    return response["results"]
+# 当前有效持仓：持仓数量 > 0
+HOLDINGS_ACTIVE_FILTER = {
+    "property": "当前持仓数量",
+    "number": {"greater_than": 0}
+}
+
+
+def notion_get_holdings_rows(notion, HOLDINGS_DATABASE_ID):
+    """
+    Holdings 数据库
+    【账户聚合读取】方法
+    当前有效持仓的所有行（生成器，逐页流式返回）
+    """
+    return notion_iter_rows(notion, HOLDINGS_DATABASE_ID, filter=HOLDINGS_ACTIVE_FILTER)
 
 
 def notion_create_account_snapshot(
@@ -159,123 +714,116 @@ def notion_create_account_snapshot(
     )
 
 
+# === Holdings 增量扫描水位（last_edited_time high-water mark）===
+HOLDINGS_SYNC_WATERMARK_KEY_PREFIX = "notion_hwm:summary_sync:"
+# Notion 的 last_edited_time 精确到分钟，水位向前多留一分钟，避免漏掉同一分钟内的修改
+WATERMARK_SAFETY_MARGIN = timedelta(minutes=1)
+
+
+def get_holdings_sync_watermark(HOLDINGS_DB_ID: str):
+    """读取上次成功扫描的水位（ISO 时间字符串），不存在返回 None"""
+    redis_client = get_redis()
+    if not redis_client:
+        return None
+    return redis_client.get(f"{HOLDINGS_SYNC_WATERMARK_KEY_PREFIX}{HOLDINGS_DB_ID}")
+
+
+def _watermark(scan_started_at: datetime):
+    """扫描开始时间 → 水位（ISO 字符串，按分钟取整并留出安全余量）"""
+    watermark = scan_started_at.replace(second=0, microsecond=0) - WATERMARK_SAFETY_MARGIN
+    return watermark.isoformat(timespec="seconds")
+
+
+def save_holdings_sync_watermark(HOLDINGS_DB_ID: str, scan_started_at: datetime):
+    """扫描成功后保存水位：下次只查看在本次扫描开始之后修改过的行"""
+    redis_client = get_redis()
+    if not redis_client:
+        return
+    redis_client.set(f"{HOLDINGS_SYNC_WATERMARK_KEY_PREFIX}{HOLDINGS_DB_ID}", _watermark(scan_started_at))
+
+
 def notion_get_pending_or_error_holdings(
     notion: Client,
     HOLDINGS_DB_ID: str,
+    since: str = None,
 ):
     """
-    获取需要进行 Summary 同步的 Holdings 行：
+    获取需要进行 Summary 同步的 Holdings 行（筛选在 Notion 服务端完成）：
     - Summary Sync Status = pending
     - Summary Sync Status = error
     - Summary Sync Status 为空（未设置）
-    """
-
-    db_response = notion.databases.retrieve(
-        database_id=HOLDINGS_DB_ID
-    )
-
-    data_sources = db_response.get("data_sources", [])
-    if not data_sources:
-        raise ValueError("No data sources found in Holdings DB")
-
-    data_source_id = data_sources[0]["id"]
 
-    # ⚠️ 不在 query 里做复杂筛选，全部拉回后代码判断
-    response = notion.data_sources.query(
-        data_source_id=data_source_id
-    )
-
-    result = []
-
-    for row in response["results"]:
-        props = row["properties"]
-
-        status_prop = props.get("Summary Sync Status")
+    :param since: ISO 时间；传入时只返回 last_edited_time >= since 的行（增量模式）
+    """
+    return list(notion_iter_rows(notion, HOLDINGS_DB_ID, filter=pending_holdings_filter(since)))
 
-        # 没有这个字段（理论不该发生，但兜底）
-        if not status_prop:
-            result.append(row)
-            continue
 
-        select_val = status_prop.get("select")
+def pending_holdings_filter(since: str = None):
+    """待同步 Holdings 行的查询条件（见 notion_get_pending_or_error_holdings）"""
+    status_filter = {
+        "or": [
+            {"property": "Summary Sync Status", "select": {"equals": "pending"}},
+            {"property": "Summary Sync Status", "select": {"equals": "error"}},
+            {"property": "Summary Sync Status", "select": {"is_empty": True}},
+        ]
+    }
 
-        # 为空（未选择）
-        if select_val is None:
-            result.append(row)
-            continue
+    if since:
+        query_filter = {
+            "and": [
+                status_filter,
+                {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since}},
+            ]
+        }
+    else:
+        query_filter = status_filter
 
-        status_name = select_val.get("name")
+    return query_filter
 
-        if status_name in ("pending", "error"):
-            result.append(row)
 
-    return result
+def _sync_status_properties(status: str):
+    return {
+        "Summary Sync Status": {
+            "select": {
+                "name": status
+            }
+        }
+    }
 
 
+def _sync_status_updates(rows: list, status: str):
+    return {
+        row["id"]: (row["id"], _sync_status_properties(status))
+        for row in rows
+    }
 
 
 def mark_holdings_as_synced(notion: Client, rows: list):
-    for row in rows:
-        notion.pages.update(
-            page_id=row["id"],
-            properties={
-                "Summary Sync Status": {
-                    "select": {
-                        "name": "synced"
-                    }
-                }
-            }
-        )
+    return notion_update_pages(notion, _sync_status_updates(rows, "synced"))
 
 def mark_holdings_as_error(notion: Client, rows: list, message: str = ""):
-    for row in rows:
-        notion.pages.update(
-            page_id=row["id"],
-            properties={
-                "Summary Sync Status": {
-                    "select": {
-                        "name": "error"
-                    }
-                }
-            }
-        )
-
+    return notion_update_pages(notion, _sync_status_updates(rows, "error"))
 
-def sync_summary_for_new_holdings_rows(
-    notion: Client,
-    new_holdings_rows: list,
-    SUMMARY_DB_ID: str,
-):
-    """
-    根据 Holdings 行同步 Crypto Summary（最终生产版）
 
-    行为：
-    - Summary 唯一键：(币种 + Global/账本)
-    - Summary.Global 继承 Holdings.账本
-    - 单行失败不中断整体
-    - 失败行标记为 error，并打印关键信息
-    """
+# === Summary (symbol, ledger_id) 持久索引（Redis set）===
+SUMMARY_INDEX_KEY_PREFIX = "notion_summary_index:"
+SUMMARY_INDEX_BATCH = 500  # 重建时每批 SADD 的成员数
 
-    # ==================================================
-    # 1. 读取已有 Summary 的 (symbol, ledger) 键
-    # ==================================================
-    summary_keys = set()
 
-    db_response = notion.databases.retrieve(
-        database_id=SUMMARY_DB_ID
-    )
+def _summary_index_keys(SUMMARY_DB_ID: str):
+    """(成员集合 key, 期望成员数 key)；后者用于校验集合是否被淘汰/损坏"""
+    set_key = f"{SUMMARY_INDEX_KEY_PREFIX}{SUMMARY_DB_ID}"
+    return set_key, f"{set_key}:count"
 
-    data_sources = db_response.get("data_sources", [])
-    if not data_sources:
-        raise ValueError("No data sources found in Summary DB")
 
-    data_source_id = data_sources[0]["id"]
+def _summary_member(key):
+    symbol, ledger_id = key
+    return f"{symbol}|{ledger_id}"
 
-    resp = notion.data_sources.query(
-        data_source_id=data_source_id
-    )
 
-    for row in resp["results"]:
+def _iter_summary_keys(notion: Client, SUMMARY_DB_ID: str):
+    """流式扫描 Summary 数据库，逐个产出已有的 (symbol, ledger_id)"""
+    for row in notion_iter_rows(notion, SUMMARY_DB_ID):
         props = row.get("properties", {})
 
         title_arr = props.get("币种", {}).get("title", [])
@@ -290,16 +838,114 @@ def sync_summary_for_new_holdings_rows(
             continue
         ledger_id = ledger_rel[0]["id"]
 
-        summary_keys.add((symbol, ledger_id))
+        yield (symbol, ledger_id)
+
+
+def summary_index_rebuild(notion: Client, SUMMARY_DB_ID: str):
+    """
+    扫描 Summary 数据库重建索引
+
+    先写入临时 key，完成后 RENAME 原子替换，重建期间读者仍使用旧索引
+    """
+    redis_client = get_redis()
+    set_key, count_key = _summary_index_keys(SUMMARY_DB_ID)
+    building_key = f"{set_key}:building"
+    redis_client.delete(building_key)
+
+    members = set()
+
+    def flush():
+        if members:
+            redis_client.sadd(building_key, *members)
+            members.clear()
+
+    for key in _iter_summary_keys(notion, SUMMARY_DB_ID):
+        members.add(_summary_member(key))
+        if len(members) >= SUMMARY_INDEX_BATCH:
+            flush()
+    flush()
+
+    total = redis_client.scard(building_key)
+    if total:
+        redis_client.rename(building_key, set_key)
+    else:
+        redis_client.delete(set_key)
+    redis_client.set(count_key, total)
+
+    print(f"Summary 索引已重建: {total} 条")
+    return total
+
+
+def summary_index_is_valid(SUMMARY_DB_ID: str):
+    """索引存在且成员数与记录一致"""
+    redis_client = get_redis()
+    set_key, count_key = _summary_index_keys(SUMMARY_DB_ID)
+    expected = redis_client.get(count_key)
+    return expected is not None and redis_client.scard(set_key) == int(expected)
+
+
+def summary_index_contains(SUMMARY_DB_ID: str, keys: list):
+    """一次 pipeline 往返检查多个 (symbol, ledger_id) 是否已存在，返回已存在的 key 集合"""
+    redis_client = get_redis()
+    if not keys:
+        return set()
+    set_key, _ = _summary_index_keys(SUMMARY_DB_ID)
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.sismember(set_key, _summary_member(key))
+    return {key for key, exists in zip(keys, pipe.execute()) if exists}
+
+
+def summary_index_add(SUMMARY_DB_ID: str, key):
+    """pages.create 成功后登记到索引"""
+    redis_client = get_redis()
+    set_key, count_key = _summary_index_keys(SUMMARY_DB_ID)
+    if redis_client.sadd(set_key, _summary_member(key)):
+        redis_client.incr(count_key)
+
+
+def sync_summary_for_new_holdings_rows(
+    notion: Client,
+    new_holdings_rows: list,
+    SUMMARY_DB_ID: str,
+    rebuild_index: bool = False,
+    max_workers: int = NOTION_MAX_CONCURRENCY,
+):
+    """
+    根据 Holdings 行同步 Crypto Summary（最终生产版）
+
+    行为：
+    - Summary 唯一键：(币种 + Global/账本)，存在性检查走 Redis 持久索引
+    - 索引缺失 / 校验失败 / rebuild_index=True 时才全量扫描 Summary 重建
+    - 同一批次中相同 key 的行先合并，只创建一次
+    - Summary.Global 继承 Holdings.账本
+    - 创建与状态写入经有界并发管道执行（共享令牌桶）
+    - 每行只写一次最终状态：synced（已创建）/ skipped（已存在或同批重复）/ error（失败）
+    - 单行失败不中断整体，失败行打印关键信息
+    - 状态写入失败的行 last_edited_time 不会更新，增量扫描看不到它们：
+      返回的 status_failed_count 不为 0 时，调用方不应推进增量水位
+    """
+    redis_client = get_redis()
 
     # ==================================================
-    # 2. 逐行处理 Holdings（单行容错）
+    # 1. 准备 (symbol, ledger) 索引
+    # ==================================================
+    if redis_client and (rebuild_index or not summary_index_is_valid(SUMMARY_DB_ID)):
+        summary_index_rebuild(notion, SUMMARY_DB_ID)
+
+    # ==================================================
+    # 2. 解析 Holdings 行 + 按 key 分组（批内去重）
     # ==================================================
     created = []
     failed = []
+    skipped = []
+    status_failed = []  # 状态写入失败的 Holdings 行 id
+    groups = {}         # key -> [(holding_id, symbol, ledger_rel), ...]，第一行负责创建
+    invalid_rows = []   # (holding_id, symbol, error_msg)
 
     for row in new_holdings_rows:
         holding_id = row.get("id")
+        symbol = None
 
         try:
             props = row.get("properties", {})
@@ -318,85 +964,110 @@ def sync_summary_for_new_holdings_rows(
             if not ledger_rel:
                 raise ValueError("Missing 账本 relation")
 
-            ledger_id = ledger_rel[0]["id"]
-            key = (symbol, ledger_id)
-
-            # ---------- 已存在则跳过 ----------
-            if key in summary_keys:
-                continue
+            key = (symbol, ledger_rel[0]["id"])
+            groups.setdefault(key, []).append((holding_id, symbol, ledger_rel))
 
-            # ---------- 创建 Summary ----------
-            notion.pages.create(
-                parent={"database_id": SUMMARY_DB_ID},
-                properties={
-                    "币种": {
-                        "title": [
-                            {"text": {"content": symbol}}
-                        ]
-                    },
-                    # 🔑 关键修复点
-                    "持仓币种": {
-                        "relation": [
-                            {
-                                "id": holding_id  # 当前这条 Holdings 行
-                            }
-                        ]
-                    },
-                    "Global": {
-                        "relation": ledger_rel
-                    }
-                }
-            )
-
-
-            summary_keys.add(key)
+        except Exception as e:
+            invalid_rows.append((holding_id, symbol, str(e)))
 
-            created.append({
-                # "holding_id": holding_id,
-                "symbol": symbol
-                # "ledger_id": ledger_id
-            })
+    if redis_client:
+        existing = summary_index_contains(SUMMARY_DB_ID, list(groups))
+    else:
+        # 没有 Redis：退化为本次全量扫描
+        existing = set(_iter_summary_keys(notion, SUMMARY_DB_ID)) & set(groups)
 
-        except Exception as e:
-            # ==================================================
-            # ❌ 单行失败：打印关键信息 + 标记 error
-            # ==================================================
-            error_msg = str(e)
+    # ==================================================
+    # 3. 并发管道：创建 Summary + 每行写一次最终状态
+    # ==================================================
+    def log_error(holding_id, symbol, ledger_id, error_msg):
+        print(
+            "[Summary Sync ERROR]",
+            f"holding_id={holding_id}",
+            f"symbol={symbol or 'UNKNOWN'}",
+            f"ledger_id={ledger_id or 'NONE'}",
+            f"error={error_msg}"
+        )
 
+    def write_status(holding_id, status):
+        get_notion_rate_limiter().acquire()
+        try:
+            notion.pages.update(page_id=holding_id, properties=_sync_status_properties(status))
+        except Exception as update_err:
+            status_failed.append(holding_id)
             print(
-                "[Summary Sync ERROR]",
+                "[Summary Sync ERROR][Status Update Failed]",
                 f"holding_id={holding_id}",
-                f"symbol={symbol if 'symbol' in locals() else 'UNKNOWN'}",
-                f"ledger_id={ledger_id if 'ledger_id' in locals() else 'NONE'}",
-                f"error={error_msg}"
+                f"status={status}",
+                f"error={update_err}"
             )
 
+    def process_invalid(holding_id, symbol, error_msg):
+        log_error(holding_id, symbol, None, error_msg)
+        failed.append({"error": error_msg})
+        write_status(holding_id, "error")
+
+    def process_group(key, rows):
+        holding_id, symbol, ledger_rel = rows[0]
+
+        if key in existing:
+            statuses = ["skipped"] * len(rows)
+            skipped.extend({"symbol": symbol} for _ in rows)
+        else:
             try:
-                notion.pages.update(
-                    page_id=holding_id,
+                # ---------- 创建 Summary ----------
+                get_notion_rate_limiter().acquire()
+                notion.pages.create(
+                    parent={"database_id": SUMMARY_DB_ID},
                     properties={
-                        "Summary Sync Status": {
-                            "select": {
-                                "name": "error"
-                            }
+                        "币种": {
+                            "title": [
+                                {"text": {"content": symbol}}
+                            ]
+                        },
+                        # 🔑 关键修复点
+                        "持仓币种": {
+                            "relation": [
+                                {
+                                    "id": holding_id  # 当前这条 Holdings 行
+                                }
+                            ]
+                        },
+                        "Global": {
+                            "relation": ledger_rel
                         }
                     }
                 )
-            except Exception as update_err:
-                print(
-                    "[Summary Sync ERROR][Status Update Failed]",
-                    f"holding_id={holding_id}",
-                    f"error={update_err}"
-                )
 
-            failed.append({
-                # "holding_id": holding_id,
-                "error": error_msg
-            })
+                if redis_client:
+                    summary_index_add(SUMMARY_DB_ID, key)
+
+                created.append({"symbol": symbol})
+                skipped.extend({"symbol": symbol} for _ in rows[1:])
+                statuses = ["synced"] + ["skipped"] * (len(rows) - 1)
+
+            except Exception as e:
+                # 创建失败：同组的行都保持 error，下次重新同步
+                error_msg = str(e)
+                log_error(holding_id, symbol, key[1], error_msg)
+                failed.extend({"error": error_msg} for _ in rows)
+                statuses = ["error"] * len(rows)
+
+        for (row_id, _, _), status in zip(rows, statuses):
+            write_status(row_id, status)
+
+    tasks = {}
+    for holding_id, symbol, error_msg in invalid_rows:
+        tasks[("invalid", holding_id)] = (lambda args=(holding_id, symbol, error_msg): process_invalid(*args))
+    for key, rows in groups.items():
+        tasks[key] = (lambda key=key, rows=rows: process_group(key, rows))
+
+    notion_run_concurrent(tasks, max_workers, rate_limited=False)
 
     return {
         "created_count": len(created),
         "failed_count": len(failed),
+        "skipped_count": len(skipped),
+        "status_failed_count": len(status_failed),
         "created": created,
         "failed": failed
     }
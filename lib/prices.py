@@ -0,0 +1,159 @@
+import time
+import hashlib
+import threading
+import requests
+
+from lib.cmc import cmc_get_quotes
+from lib.redis import CACHE_SOFT_TTL, cache_get_quotes, cache_set_quotes, single_flight
+from lib.stream import stream_publish
+from lib.timeseries import ts_append
+from lib.utils import get_cmc_field_data
+
+
+# 正在后台刷新的 symbol，保证同一 symbol 同时只有一个刷新
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def fetch_fresh_quotes(api_key, symbols):
+    """
+    从 CMC 拉取报价并写入缓存 / 时间序列，同时发布价格推送增量
+
+    返回 {symbol: quote}；CMC 返回中缺失/异常的 symbol 不出现在结果中。
+    请求失败时抛出 requests.exceptions.RequestException。
+    """
+    cmc_data = cmc_get_quotes(api_key, symbols)
+
+    now = time.time()
+    fresh_data = {}
+    for symbol in symbols:
+        try:
+            fresh_data[symbol] = {
+                "price": get_cmc_field_data(cmc_data, symbol, "price"),
+                "change_24h": get_cmc_field_data(cmc_data, symbol, "percent_change_24h"),
+                "ts": now,
+                "age": 0.0
+            }
+            print(f"Fresh {symbol}: ${fresh_data[symbol]['price']:,.4f}")
+        except Exception as e:
+            print(f"获取 {symbol} 失败: {e}")
+
+    # 批量写入缓存（一次事务），并追加到时间序列
+    cache_set_quotes(fresh_data)
+    ts_append(fresh_data)
+    try:
+        stream_publish(fresh_data)
+    except Exception as e:
+        # 推送失败不影响刷新结果
+        print("价格推送发布失败:", e)
+    return fresh_data
+
+
+def _flight_name(symbols):
+    """symbol 集合的稳定标识，作为 single-flight 锁名"""
+    return hashlib.sha1(",".join(sorted(symbols)).encode()).hexdigest()
+
+
+def _refresh_in_background(api_key, symbols):
+    """后台刷新过期报价；已在刷新中的 symbol 跳过"""
+    with _refreshing_lock:
+        symbols = [s for s in symbols if s not in _refreshing]
+        _refreshing.update(symbols)
+    if not symbols:
+        return None
+
+    def run():
+        try:
+            # 不等待：其他实例已在刷新同一批 symbol 时直接放弃
+            with single_flight(_flight_name(symbols), wait_timeout=0) as leader:
+                if leader:
+                    fetch_fresh_quotes(api_key, symbols)
+        except requests.exceptions.RequestException as e:
+            # 刷新失败保留旧缓存，下次读取时再触发
+            print("CMC 后台刷新失败:", e)
+        finally:
+            with _refreshing_lock:
+                _refreshing.difference_update(symbols)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def get_cached_price_data(symbols, soft_ttl=CACHE_SOFT_TTL):
+    """只读缓存（不请求 CMC），返回格式同 get_price_data，未命中为 None"""
+    cached = cache_get_quotes(symbols)
+    for quote in cached.values():
+        quote["stale"] = quote["age"] >= soft_ttl
+    return {symbol: cached.get(symbol) for symbol in symbols}
+
+
+def get_price_data(api_key, symbols, soft_ttl=CACHE_SOFT_TTL, refresh_stale=False):
+    """
+    stale-while-revalidate 读取报价
+
+    - age < soft TTL：直接返回缓存
+    - soft TTL ≤ age < hard TTL：先返回过期数据，同时后台刷新一次
+      （refresh_stale=True 时与缓存缺失一样同步刷新，供 cron 等写入路径使用）
+    - 缓存缺失：同步请求 CMC
+    - CMC 失败：逐个 symbol 回退到最后一次成功的报价（仍在 hard TTL 内），没有则为 None
+
+    返回 {symbol: {"price", "change_24h", "ts", "age", "stale"} | None}
+    """
+    cached = cache_get_quotes(symbols)
+
+    price_data = {}
+    stale_symbols = []
+    missing_symbols = []
+    stale_fallback = {}
+
+    for symbol in symbols:
+        quote = cached.get(symbol)
+        if not quote:
+            missing_symbols.append(symbol)
+            continue
+        quote["stale"] = quote["age"] >= soft_ttl
+        if quote["stale"] and refresh_stale:
+            stale_fallback[symbol] = quote
+            missing_symbols.append(symbol)
+            continue
+        price_data[symbol] = quote
+        if quote["stale"]:
+            stale_symbols.append(symbol)
+        else:
+            print(f"Cache hit: {symbol} | price={quote['price']} | change={quote['change_24h']}")
+
+    if stale_symbols:
+        print(f"Serving {len(stale_symbols)} stale symbols, refreshing in background: {stale_symbols}")
+        _refresh_in_background(api_key, stale_symbols)
+
+    if not missing_symbols:
+        print("All prices from cache!")
+        return price_data
+
+    print(f"Fetching {len(missing_symbols)} symbols from CMC: {missing_symbols}")
+    try:
+        with single_flight(_flight_name(missing_symbols)) as leader:
+            if leader:
+                fresh_data = fetch_fresh_quotes(api_key, missing_symbols)
+                for quote in fresh_data.values():
+                    quote["stale"] = False
+            else:
+                # 其他实例刚完成刷新：直接读取它写入的缓存
+                print(f"Waited for concurrent refresh of {len(missing_symbols)} symbols")
+                fresh_data = cache_get_quotes(missing_symbols)
+                for quote in fresh_data.values():
+                    quote["stale"] = quote["age"] >= soft_ttl
+    except requests.exceptions.RequestException as e:
+        print("CMC 请求失败:", e)
+        # 其他实例可能已写入：重新读取一次旧缓存作为兜底
+        fresh_data = cache_get_quotes(missing_symbols)
+        for symbol, quote in fresh_data.items():
+            quote["stale"] = quote["age"] >= soft_ttl
+            print(f"Fallback to old cache for {symbol}")
+
+    for symbol in missing_symbols:
+        # CMC 未返回该 symbol 时保留过期报价
+        price_data[symbol] = fresh_data.get(symbol) or stale_fallback.get(symbol)
+
+    return price_data
@@ -0,0 +1,122 @@
+import json
+import time
+
+import numpy as np
+import requests
+
+from lib.cmc import cmc_get_reference_rates
+from lib.config import env
+from lib.redis import get_redis, single_flight
+
+
+# === 参考汇率：报价缓存只存 USD，其他货币在本地换算 ===
+# 表结构：{"rates": {currency: 1 USD 可兑换的数量}, "currencies": 请求的货币, "ts": 刷新时间}
+BASE_CURRENCY = "USD"
+REFERENCE_RATES_KEY = "reference_rates"
+REFERENCE_RATES_TTL = 3600              # 秒，超过后下一次带 api_key 的调用刷新（独立于报价的刷新节奏）
+REFERENCE_RATES_HARD_TTL = 7 * 24 * 3600  # 刷新失败时旧汇率最多保留的时间
+
+# 没有 Redis 时的进程内副本
+_local_rates = None
+
+
+class ReferenceRateUnavailable(Exception):
+    """货币已配置，但还没有可用的参考汇率（从未成功刷新）"""
+
+
+def reference_currencies():
+    """配置的参考货币（环境变量 REFERENCE_CURRENCIES，逗号分隔，如 EUR,CNY,BTC），第一个总是 USD"""
+    configured = [c.strip().upper() for c in env("REFERENCE_CURRENCIES", "").split(",") if c.strip()]
+    return [BASE_CURRENCY] + [c for c in dict.fromkeys(configured) if c != BASE_CURRENCY]
+
+
+def _load_table():
+    redis_client = get_redis()
+    if not redis_client:
+        return _local_rates
+    cached = redis_client.get(REFERENCE_RATES_KEY)
+    return json.loads(cached) if cached else None
+
+
+def _store_table(table):
+    global _local_rates
+    redis_client = get_redis()
+    if redis_client:
+        redis_client.setex(REFERENCE_RATES_KEY, REFERENCE_RATES_HARD_TTL, json.dumps(table))
+    else:
+        _local_rates = table
+
+
+def refresh_reference_rates(api_key):
+    """一次 CMC 请求刷新所有参考汇率；其他实例正在刷新时等待并读取其结果"""
+    currencies = reference_currencies()
+    with single_flight(REFERENCE_RATES_KEY) as leader:
+        if not leader:
+            return _load_table()
+        table = {
+            "rates": cmc_get_reference_rates(api_key, currencies),
+            "currencies": currencies,
+            "ts": time.time()
+        }
+        _store_table(table)
+        print(f"参考汇率已刷新: {table['rates']}")
+        return table
+
+
+def get_reference_rates(api_key=None):
+    """
+    读取参考汇率，返回 {currency: 1 USD 可兑换的数量}（含 USD: 1.0）
+
+    - 汇率表过期或货币配置变化，且传入 api_key 时刷新；不传时只读缓存
+    - 刷新失败继续使用旧汇率；没有汇率的货币不出现在结果中
+    """
+    currencies = reference_currencies()
+    table = _load_table()
+    stale = (
+        table is None
+        or time.time() - table["ts"] >= REFERENCE_RATES_TTL
+        or table.get("currencies") != currencies
+    )
+    if stale and api_key and len(currencies) > 1:
+        try:
+            table = refresh_reference_rates(api_key) or table
+        except requests.exceptions.RequestException as e:
+            print("参考汇率刷新失败，继续使用旧汇率:", e)
+
+    rates = {BASE_CURRENCY: 1.0}
+    if table:
+        rates.update({c: table["rates"][c] for c in currencies if c in table["rates"]})
+    return rates
+
+
+def convert_price_data(price_data, currencies, rates):
+    """
+    向量化换算：USD 报价向量 × 参考汇率向量（外积），一次得到 currencies 中所有货币的价格
+
+    :param price_data: get_price_data 的返回值（USD 计价），值可以为 None
+    :return: {currency: 与 price_data 同结构的报价}；change_24h 仍为 USD 计价的涨跌幅
+    """
+    missing = [c for c in currencies if c not in rates]
+    if missing:
+        raise ReferenceRateUnavailable(f"Reference rate unavailable: {','.join(missing)}")
+
+    symbols = [symbol for symbol, quote in price_data.items() if quote]
+    usd_prices = np.array([price_data[symbol]["price"] for symbol in symbols], dtype=np.float64)
+    factors = np.array([rates[c] for c in currencies], dtype=np.float64)
+    converted = np.multiply.outer(usd_prices, factors)  # (symbol, currency)
+
+    result = {}
+    for j, currency in enumerate(currencies):
+        prices = dict(zip(symbols, converted[:, j].tolist()))
+        result[currency] = {
+            symbol: dict(quote, price=prices[symbol], currency=currency) if quote else None
+            for symbol, quote in price_data.items()
+        }
+    return result
+
+
+def price_data_in(price_data, currency, rates):
+    """单一货币的换算；USD 直接返回原数据"""
+    if currency == BASE_CURRENCY:
+        return price_data
+    return convert_price_data(price_data, [currency], rates)[currency]
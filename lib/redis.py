@@ -1,49 +1,569 @@
-import os
 import time
-from redis import Redis
+import uuid
+import queue
+import threading
+import json
+from contextlib import contextmanager
 
-# === Redis（Vercel Redis 数据库）配置 ===
-REDIS_URL = os.environ.get("REDIS_URL")
+from lib.cache import LRUTTLCache
+from lib.config import env
+from lib.metrics import InstrumentedRedis, inc
 
 # === 缓存配置 ===
-CACHE_TTL = 300  # 5分钟
+CACHE_SOFT_TTL = 300         # 5分钟内视为新鲜，直接使用
+CACHE_HARD_TTL = 24 * 3600   # 超过 soft TTL 仍保留到 hard TTL，作为过期兜底数据
 CACHE_KEY_PREFIX = "cmc_api_cache:"
 
-redis_client = None
+# === L1 进程内缓存（位于 Redis 之前）===
+L1_CACHE_MAXSIZE = 2048
+L1_CACHE_TTL = 60  # 秒；即使漏收失效消息，最多 60 秒后回源 Redis
+L1_INVALIDATE_CHANNEL = f"{CACHE_KEY_PREFIX}invalidate"
+L1_INVALIDATE_RECONNECT_DELAY = 1  # 秒，失效订阅断开后重连的间隔
 
-if REDIS_URL:
-    try:
-        redis_client = Redis.from_url(REDIS_URL, decode_responses=True)
-        redis_client.ping()
-        print("Redis 连接成功！")
-    except Exception as e:
-        print("Redis 连接失败，将禁用缓存:", e)
-        redis_client = None
-else:
-    print("未找到 REDIS_URL 环境变量，Redis 缓存禁用")
-
-
-
-# === 本地开发模式使用 FakeRedis（仅非 production）===
-if not redis_client and os.environ.get("VERCEL_ENV") != "production":
-    class FakeRedis:
-        def __init__(self):
-            self.store = {}
-            self.ttl = {}
-
-        def setex(self, key, ttl, value):
-            self.store[key] = value
+class FakeRedis:
+    """
+    本地开发用的内存版 Redis，只实现项目用到的命令子集。
+    值统一转成 str 存储，与 decode_responses=True 的真实客户端行为一致。
+    """
+
+    is_local = True
+
+    def __init__(self):
+        self.store = {}
+        self.ttl = {}
+        self._lock = threading.RLock()
+        self._channels = {}  # channel -> {FakePubSub}
+
+    def _alive(self, key):
+        if key in self.store and (key not in self.ttl or time.time() < self.ttl[key]):
+            return True
+        self.store.pop(key, None)
+        self.ttl.pop(key, None)
+        return False
+
+    def set(self, key, value, nx=False, ex=None):
+        with self._lock:
+            if nx and self._alive(key):
+                return None
+            self.store[key] = str(value)
+            if ex:
+                self.ttl[key] = time.time() + ex
+            else:
+                self.ttl.pop(key, None)
+            return True
+
+    def setex(self, key, ttl, value):
+        with self._lock:
+            self.store[key] = str(value)
             self.ttl[key] = time.time() + ttl
 
-        def get(self, key):
-            if key in self.store and (key not in self.ttl or time.time() < self.ttl[key]):
-                return self.store[key]
-            self.store.pop(key, None)
-            self.ttl.pop(key, None)
-            return None
+    def get(self, key):
+        with self._lock:
+            return self.store[key] if self._alive(key) else None
+
+    def mget(self, keys):
+        with self._lock:
+            return [self.get(key) for key in keys]
+
+    def delete(self, *keys):
+        with self._lock:
+            removed = 0
+            for key in keys:
+                if self._alive(key):
+                    removed += 1
+                self.store.pop(key, None)
+                self.ttl.pop(key, None)
+            return removed
+
+    def incr(self, key, amount=1):
+        return self.incrby(key, amount)
 
-        def ping(self):
+    def incrby(self, key, amount=1):
+        with self._lock:
+            value = int(self.store[key]) + amount if self._alive(key) else amount
+            self.store[key] = str(value)
+            return value
+
+    def expire(self, key, ttl):
+        with self._lock:
+            if not self._alive(key):
+                return False
+            self.ttl[key] = time.time() + ttl
             return True
 
-    redis_client = FakeRedis()
-    print("Using in-memory FakeRedis for local development")
+    def hset(self, name, key=None, value=None, mapping=None):
+        with self._lock:
+            if not self._alive(name):
+                self.store[name] = {}
+            h = self.store[name]
+            items = dict(mapping or {})
+            if key is not None:
+                items[key] = value
+            added = sum(1 for k in items if k not in h)
+            h.update({k: str(v) for k, v in items.items()})
+            return added
+
+    def hget(self, name, key):
+        with self._lock:
+            return self.store[name].get(key) if self._alive(name) else None
+
+    def hmget(self, name, keys):
+        with self._lock:
+            return [self.hget(name, key) for key in keys]
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self.store[name]) if self._alive(name) else {}
+
+    def hsetnx(self, name, key, value):
+        with self._lock:
+            if self._alive(name) and key in self.store[name]:
+                return 0
+            return self.hset(name, key, value)
+
+    def hdel(self, name, *keys):
+        with self._lock:
+            if not self._alive(name):
+                return 0
+            h = self.store[name]
+            removed = sum(1 for key in keys if h.pop(key, None) is not None)
+            if not h:
+                self.delete(name)
+            return removed
+
+    def hlen(self, name):
+        with self._lock:
+            return len(self.store[name]) if self._alive(name) else 0
+
+    def hvals(self, name):
+        with self._lock:
+            return list(self.store[name].values()) if self._alive(name) else []
+
+    def hkeys(self, name):
+        with self._lock:
+            return list(self.store[name]) if self._alive(name) else []
+
+    def rpush(self, name, *values):
+        with self._lock:
+            if not self._alive(name):
+                self.store[name] = []
+            self.store[name].extend(str(v) for v in values)
+            return len(self.store[name])
+
+    def lrange(self, name, start, end):
+        with self._lock:
+            if not self._alive(name):
+                return []
+            # Redis 的 end 为闭区间，-1 表示到末尾
+            return self.store[name][start:None if end == -1 else end + 1]
+
+    def ltrim(self, name, start, end):
+        with self._lock:
+            if self._alive(name):
+                self.store[name] = self.lrange(name, start, end)
+            return True
+
+    def lpop(self, name, count=None):
+        with self._lock:
+            if not self._alive(name):
+                return None
+            items = self.store[name]
+            popped = items[:count or 1]
+            del items[:count or 1]
+            if not items:
+                self.delete(name)
+            return popped if count else popped[0]
+
+    def llen(self, name):
+        with self._lock:
+            return len(self.store[name]) if self._alive(name) else 0
+
+    def sadd(self, name, *values):
+        with self._lock:
+            if not self._alive(name):
+                self.store[name] = set()
+            members = self.store[name]
+            added = sum(1 for v in values if str(v) not in members)
+            members.update(str(v) for v in values)
+            return added
+
+    def sismember(self, name, value):
+        with self._lock:
+            return self._alive(name) and str(value) in self.store[name]
+
+    def smembers(self, name):
+        with self._lock:
+            return set(self.store[name]) if self._alive(name) else set()
+
+    def srem(self, name, *values):
+        with self._lock:
+            if not self._alive(name):
+                return 0
+            members = self.store[name]
+            removed = sum(1 for v in values if str(v) in members)
+            members.difference_update(str(v) for v in values)
+            if not members:
+                self.delete(name)
+            return removed
+
+    def scard(self, name):
+        with self._lock:
+            return len(self.store[name]) if self._alive(name) else 0
+
+    def rename(self, src, dst):
+        with self._lock:
+            if not self._alive(src):
+                raise KeyError("no such key")
+            self.store[dst] = self.store.pop(src)
+            self.ttl.pop(dst, None)
+            if src in self.ttl:
+                self.ttl[dst] = self.ttl.pop(src)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def publish(self, channel, message):
+        """投递给本进程内订阅了该频道的 FakePubSub，返回接收者数量"""
+        with self._lock:
+            receivers = list(self._channels.get(channel, ()))
+        for pubsub in receivers:
+            pubsub._messages.put({"type": "message", "pattern": None, "channel": channel, "data": str(message)})
+        return len(receivers)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self, ignore_subscribe_messages)
+
+    def ping(self):
+        return True
+
+
+class FakePubSub:
+    """
+    FakeRedis 的 pub/sub：消息放入进程内队列，
+    get_message / listen 的返回格式与 redis-py 一致。
+    """
+
+    def __init__(self, client, ignore_subscribe_messages=False):
+        self._client = client
+        self._ignore_subscribe_messages = ignore_subscribe_messages
+        self._messages = queue.Queue()
+        self.channels = set()
+
+    def subscribe(self, *channels):
+        with self._client._lock:
+            for channel in channels:
+                self._client._channels.setdefault(channel, set()).add(self)
+                self.channels.add(channel)
+                self._messages.put({"type": "subscribe", "pattern": None, "channel": channel, "data": len(self.channels)})
+
+    def unsubscribe(self, *channels):
+        with self._client._lock:
+            for channel in channels or list(self.channels):
+                self._client._channels.get(channel, set()).discard(self)
+                self.channels.discard(channel)
+                self._messages.put({"type": "unsubscribe", "pattern": None, "channel": channel, "data": len(self.channels)})
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            try:
+                message = self._messages.get(timeout=max(deadline - time.monotonic(), 0)) if timeout else self._messages.get_nowait()
+            except queue.Empty:
+                return None
+            if message["type"] == "message" or not (ignore_subscribe_messages or self._ignore_subscribe_messages):
+                return message
+
+    def listen(self):
+        while self.channels:
+            message = self.get_message(timeout=1.0)
+            if message:
+                yield message
+
+    def close(self):
+        self.unsubscribe()
+
+
+class FakePipeline:
+    """
+    FakeRedis 的 pipeline：先缓存命令，execute() 时在锁内一次性执行，
+    保证与真实 Redis pipeline 相同的调用方式。
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        with self._client._lock:
+            results = [method(*args, **kwargs) for method, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+
+# === Redis（Vercel Redis 数据库）懒连接 ===
+# 冷启动时不导入 redis-py、不连接；首次真正使用缓存时才连接并 ping
+_redis_client = None
+_redis_initialized = False
+_redis_lock = threading.Lock()
+
+
+def _connect_redis():
+    client = None
+    redis_url = env("REDIS_URL")
+    if redis_url:
+        try:
+            from redis import Redis
+            client = Redis.from_url(redis_url, decode_responses=True)
+            client.ping()
+            print("Redis 连接成功！")
+        except Exception as e:
+            print("Redis 连接失败，将禁用缓存:", e)
+            client = None
+    else:
+        print("未找到 REDIS_URL 环境变量，Redis 缓存禁用")
+
+    # === 本地开发模式使用 FakeRedis（仅非 production）===
+    if not client and env("VERCEL_ENV") != "production":
+        client = FakeRedis()
+        print("Using in-memory FakeRedis for local development")
+
+    # 每个命令 / pipeline 的耗时计入 redis 阶段（Server-Timing 与 /api/metrics）
+    return InstrumentedRedis(client) if client else None
+
+
+def get_redis():
+    """
+    返回共享的 Redis 客户端（首次调用时连接）
+
+    连接失败且为 production 时返回 None，调用方按“无缓存”处理
+    """
+    global _redis_client, _redis_initialized
+    if not _redis_initialized:
+        with _redis_lock:
+            if not _redis_initialized:
+                _redis_client = _connect_redis()
+                _redis_initialized = True
+    return _redis_client
+
+
+def quote_cache_key(symbol):
+    """单个币种的缓存 key（一个 hash 同时存放 price / change / 抓取时间）"""
+    return f"{CACHE_KEY_PREFIX}{symbol}"
+
+
+# L1：热实例直接命中，跳过 Redis 往返
+l1_quote_cache = LRUTTLCache(maxsize=L1_CACHE_MAXSIZE, ttl=L1_CACHE_TTL)
+
+# 本实例标识，用于忽略自己发出的失效消息
+_instance_id = uuid.uuid4().hex
+_invalidation_listener = None
+_invalidation_listener_lock = threading.Lock()
+
+
+def _listen_invalidations():
+    """订阅 L1 失效消息；连接断开时重连，断开期间可能漏收消息，重连后清空 L1"""
+    reconnecting = False
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(L1_INVALIDATE_CHANNEL)
+            if reconnecting:
+                l1_quote_cache.clear()
+            for message in pubsub.listen():
+                try:
+                    payload = json.loads(message["data"])
+                    if payload.get("origin") != _instance_id:
+                        l1_quote_cache.invalidate(*payload.get("symbols", []))
+                except Exception as e:
+                    print("L1 失效消息处理失败:", e)
+        except Exception as e:
+            print("L1 失效订阅断开，稍后重连:", e)
+            inc("l1_invalidation_listener_errors_total")
+        reconnecting = True
+        time.sleep(L1_INVALIDATE_RECONNECT_DELAY)
+
+
+def _ensure_invalidation_listener():
+    """懒启动 pub/sub 监听线程：其他实例写入报价时清除本地 L1"""
+    global _invalidation_listener
+    redis_client = get_redis()
+    if _invalidation_listener is not None or redis_client is None or getattr(redis_client, "is_local", False):
+        return
+    with _invalidation_listener_lock:
+        if _invalidation_listener is None:
+            _invalidation_listener = threading.Thread(target=_listen_invalidations, daemon=True)
+            _invalidation_listener.start()
+
+
+def _with_age(row, now):
+    quote = dict(row)
+    quote["age"] = round(max(now - quote["ts"], 0.0), 3)
+    return quote
+
+
+def cache_get_quotes(symbols):
+    """
+    批量读取缓存报价：先查 L1，未命中的 symbol 只走一次 Redis pipeline 往返。
+
+    返回 {symbol: {"price": float, "change_24h": float, "ts": float, "age": float}}，
+    age 为距 CMC 抓取时的秒数；未命中的 symbol 不出现在结果中。
+    """
+    redis_client = get_redis()
+    if not redis_client or not symbols:
+        return {}
+
+    _ensure_invalidation_listener()
+
+    now = time.time()
+    quotes = {}
+    remote_symbols = []
+
+    for symbol in symbols:
+        row = l1_quote_cache.get(symbol)
+        if row:
+            quotes[symbol] = _with_age(row, now)
+        else:
+            remote_symbols.append(symbol)
+
+    inc("quote_cache_lookups_total", len(quotes), tier="l1", result="hit")
+    if not remote_symbols:
+        return quotes
+
+    pipe = redis_client.pipeline(transaction=False)
+    for symbol in remote_symbols:
+        pipe.hgetall(quote_cache_key(symbol))
+    rows = pipe.execute()
+
+    for symbol, row in zip(remote_symbols, rows):
+        if not row or "price" not in row or "change" not in row:
+            continue
+        row = {
+            "price": float(row["price"]),
+            "change_24h": float(row["change"]),
+            "ts": float(row.get("ts", now))
+        }
+        l1_quote_cache.set(symbol, row)
+        quotes[symbol] = _with_age(row, now)
+
+    redis_hits = len(quotes) - (len(symbols) - len(remote_symbols))
+    inc("quote_cache_lookups_total", redis_hits, tier="redis", result="hit")
+    inc("quote_cache_lookups_total", len(remote_symbols) - redis_hits, tier="redis", result="miss")
+    return quotes
+
+
+def cache_set_quotes(quotes, ttl=CACHE_HARD_TTL):
+    """
+    批量写入缓存报价：一个事务（MULTI/EXEC）内完成所有 HSET + EXPIRE，
+    同时更新本地 L1，并通过 pub/sub 通知其他实例清除各自的 L1。
+
+    key 的过期时间为 hard TTL；新鲜度由 ts 字段与 soft TTL 在读取时判断。
+
+    :param quotes: {symbol: {"price": float, "change_24h": float, "ts": float(可选)}}
+    """
+    redis_client = get_redis()
+    if not redis_client or not quotes:
+        return
+
+    now = time.time()
+    pipe = redis_client.pipeline(transaction=True)
+    for symbol, quote in quotes.items():
+        key = quote_cache_key(symbol)
+        row = {
+            "price": float(quote["price"]),
+            "change_24h": float(quote["change_24h"]),
+            "ts": float(quote.get("ts", now))
+        }
+        pipe.hset(key, mapping={
+            "price": row["price"],
+            "change": row["change_24h"],
+            "ts": row["ts"]
+        })
+        pipe.expire(key, ttl)
+        l1_quote_cache.set(symbol, row)
+    pipe.publish(L1_INVALIDATE_CHANNEL, json.dumps({"origin": _instance_id, "symbols": list(quotes)}))
+    pipe.execute()
+
+
+# === single-flight 锁：同一组 symbol 同一时间只有一个实例去请求 CMC ===
+LOCK_KEY_PREFIX = "cmc_api_lock:"
+LOCK_TTL = 30           # 秒，持锁实例崩溃时锁自动过期
+LOCK_WAIT_TIMEOUT = 20  # 秒，等待者最长等待时间
+LOCK_POLL_INTERVAL = 0.1
+
+# 仅当值仍是自己的 token 时才删除，避免误删其他实例在锁过期后重新拿到的锁
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# 本地（FakeRedis / 无 Redis）时的线程版实现：name -> 完成事件
+_local_flights = {}
+_local_flights_lock = threading.Lock()
+
+
+@contextmanager
+def _local_single_flight(name, wait_timeout):
+    with _local_flights_lock:
+        done = _local_flights.get(name)
+        leader = done is None
+        if leader:
+            done = _local_flights[name] = threading.Event()
+
+    if not leader:
+        done.wait(wait_timeout)
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        with _local_flights_lock:
+            _local_flights.pop(name, None)
+        done.set()
+
+
+@contextmanager
+def _redis_single_flight(name, ttl, wait_timeout):
+    key = f"{LOCK_KEY_PREFIX}{name}"
+    token = uuid.uuid4().hex
+    redis_client = get_redis()
+
+    if not redis_client.set(key, token, nx=True, ex=ttl):
+        # 其他实例正在刷新：轮询等待锁释放，之后由调用方读取新缓存
+        deadline = time.monotonic() + wait_timeout
+        while time.monotonic() < deadline and redis_client.exists(key):
+            time.sleep(LOCK_POLL_INTERVAL)
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, key, token)
+
+
+def single_flight(name, ttl=LOCK_TTL, wait_timeout=LOCK_WAIT_TIMEOUT):
+    """
+    single-flight 上下文管理器
+
+    with single_flight(name) as leader:
+        leader 为 True：拿到锁，由当前调用执行刷新
+        leader 为 False：其他调用正在刷新，已等待其完成（或超时，wait_timeout=0 时不等待）
+
+    远程 Redis 使用 SET NX EX + 轮询；本地开发使用线程事件。
+    """
+    redis_client = get_redis()
+    if redis_client is None or getattr(redis_client, "is_local", False):
+        return _local_single_flight(name, wait_timeout)
+    return _redis_single_flight(name, ttl, wait_timeout)
@@ -0,0 +1,221 @@
+import json
+import queue
+import threading
+import time
+
+from lib.metrics import inc
+from lib.redis import CACHE_KEY_PREFIX, get_redis
+
+
+# === 价格推送（SSE）：Redis pub/sub 分发 + 有界回放缓冲 ===
+# 每次刷新写入新报价时发布一条增量：{"id": 序号, "data": {symbol: [price, change_24h, ts]}}
+STREAM_CHANNEL = f"{CACHE_KEY_PREFIX}stream"
+STREAM_SEQ_KEY = f"{CACHE_KEY_PREFIX}stream:seq"        # INCR 生成单调递增的事件 id
+STREAM_REPLAY_KEY = f"{CACHE_KEY_PREFIX}stream:replay"  # list：最近的增量，供 Last-Event-ID 续传
+STREAM_REPLAY_SIZE = 500        # 回放缓冲保留的事件数
+STREAM_SUBSCRIBER_BUFFER = 100  # 每个连接的待发送事件上限，超过视为慢消费者并断开
+STREAM_RECONNECT_DELAY = 1      # 秒，pub/sub 连接断开后重连的间隔
+
+# === SSE 连接 ===
+STREAM_HEARTBEAT = 15           # 秒，没有事件时发送注释行保活，避免代理断开空闲连接
+STREAM_MAX_DURATION = 270       # 秒，Serverless 单次执行时长有限，到时结束连接，客户端带 Last-Event-ID 重连
+STREAM_RETRY_MS = 1000          # 客户端重连间隔（SSE retry 字段）
+
+# 本实例的订阅者：每个 SSE 连接一个队列，由 hub 线程统一分发
+_subscribers = set()
+_subscribers_lock = threading.Lock()
+_hub = None
+_hub_lock = threading.Lock()
+
+# 放入订阅者队列，表示连接因消费过慢被关闭
+STREAM_OVERFLOW = object()
+
+
+# 分配 id 与写入回放缓冲 / PUBLISH 在同一个脚本中原子执行：
+# 并发发布时事件按 id 顺序送达，订阅端按 id 去重不会丢掉较小的 id
+_STREAM_PUBLISH_SCRIPT = """
+local id = redis.call('incr', KEYS[1])
+local message = '{"id":' .. id .. ',"data":' .. ARGV[1] .. '}'
+redis.call('rpush', KEYS[2], message)
+redis.call('ltrim', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('publish', ARGV[3], message)
+return id
+"""
+
+# 本地 FakeRedis 不支持脚本：同一进程内用锁保证同样的顺序
+_local_publish_lock = threading.Lock()
+
+
+def stream_publish(quotes):
+    """
+    发布一条报价增量（写入回放缓冲并 PUBLISH）
+
+    :param quotes: {symbol: {"price", "change_24h", "ts"}}
+    :return: 事件 id；没有 Redis 或报价为空时返回 None
+    """
+    redis_client = get_redis()
+    if not redis_client or not quotes:
+        return None
+
+    data = json.dumps({
+        symbol: [quote["price"], quote["change_24h"], round(quote["ts"], 3)]
+        for symbol, quote in quotes.items()
+    }, separators=(",", ":"))
+
+    if not getattr(redis_client, "is_local", False):
+        return redis_client.eval(_STREAM_PUBLISH_SCRIPT, 2, STREAM_SEQ_KEY, STREAM_REPLAY_KEY,
+                                 data, STREAM_REPLAY_SIZE, STREAM_CHANNEL)
+
+    with _local_publish_lock:
+        event_id = redis_client.incr(STREAM_SEQ_KEY)
+        message = f'{{"id":{event_id},"data":{data}}}'
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.rpush(STREAM_REPLAY_KEY, message)
+        pipe.ltrim(STREAM_REPLAY_KEY, -STREAM_REPLAY_SIZE, -1)
+        pipe.publish(STREAM_CHANNEL, message)
+        pipe.execute()
+    return event_id
+
+
+def stream_replay(last_event_id):
+    """
+    读取 last_event_id 之后的事件
+
+    返回 (events, complete)：complete 为 False 表示缺失的事件已超出回放缓冲，客户端需要重新拉取全量价格
+    """
+    events = sorted(
+        (json.loads(message) for message in get_redis().lrange(STREAM_REPLAY_KEY, 0, -1)),
+        key=lambda event: event["id"]
+    )
+    missed = [event for event in events if event["id"] > last_event_id]
+    # 缓冲中最早的事件之前还有未收到的事件
+    complete = not events or events[0]["id"] <= last_event_id + 1
+    return missed, complete
+
+
+def _deliver(message):
+    try:
+        event = json.loads(message["data"])
+    except (TypeError, ValueError) as e:
+        print("价格推送消息解析失败:", e)
+        return
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            # 慢消费者：丢弃积压并通知连接关闭，客户端用 Last-Event-ID 续传
+            stream_unsubscribe(subscriber)
+            _drain(subscriber)
+            subscriber.put_nowait(STREAM_OVERFLOW)
+            inc("stream_dropped_subscribers_total")
+
+
+def _drain(subscriber):
+    while True:
+        try:
+            subscriber.get_nowait()
+        except queue.Empty:
+            return
+
+
+def _run_hub():
+    """订阅频道并把每条增量分发给本实例的所有连接；连接断开时重连"""
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(STREAM_CHANNEL)
+            for message in pubsub.listen():
+                if message.get("type") == "message":
+                    _deliver(message)
+        except Exception as e:
+            print("价格推送订阅断开，稍后重连:", e)
+            time.sleep(STREAM_RECONNECT_DELAY)
+
+
+def _ensure_hub():
+    """懒启动 hub 线程：每个实例只有一个 Redis 订阅连接"""
+    global _hub
+    if _hub is not None:
+        return
+    with _hub_lock:
+        if _hub is None:
+            _hub = threading.Thread(target=_run_hub, daemon=True)
+            _hub.start()
+
+
+def stream_subscribe():
+    """注册一个连接，返回接收事件的队列"""
+    _ensure_hub()
+    subscriber = queue.Queue(maxsize=STREAM_SUBSCRIBER_BUFFER)
+    with _subscribers_lock:
+        _subscribers.add(subscriber)
+    return subscriber
+
+
+def stream_unsubscribe(subscriber):
+    with _subscribers_lock:
+        _subscribers.discard(subscriber)
+
+
+def stream_subscriber_count():
+    with _subscribers_lock:
+        return len(_subscribers)
+
+
+def _format_event(event, symbols=None):
+    """
+    增量 → SSE 文本
+
+    按 symbols 过滤后为空时只发送 id 行：客户端不会触发事件，但 Last-Event-ID 会前进，
+    重连时不必回放已过滤掉的事件
+    """
+    data = event["data"]
+    if symbols:
+        data = {symbol: quote for symbol, quote in data.items() if symbol in symbols}
+        if not data:
+            return f"id: {event['id']}\n\n"
+    return f"id: {event['id']}\nevent: prices\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def stream_events(symbols=None, last_event_id=None, max_duration=STREAM_MAX_DURATION):
+    """
+    SSE 事件生成器
+
+    - 先订阅再回放，回放与实时事件重叠的部分按 id 去重
+    - last_event_id 之后的事件已超出回放缓冲时先发送 reset 事件，客户端应重新拉取 /api/prices
+    - symbols 为空时推送全部币种
+    """
+    subscriber = stream_subscribe()
+    last_sent = last_event_id or 0
+    deadline = time.monotonic() + max_duration
+
+    try:
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+
+        if last_event_id is not None:
+            events, complete = stream_replay(last_event_id)
+            if not complete:
+                yield "event: reset\ndata: {}\n\n"
+            for event in events:
+                last_sent = event["id"]
+                yield _format_event(event, symbols)
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                event = subscriber.get(timeout=min(STREAM_HEARTBEAT, remaining))
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if event is STREAM_OVERFLOW:
+                return
+            if event["id"] <= last_sent:
+                continue
+            last_sent = event["id"]
+            yield _format_event(event, symbols)
+    finally:
+        stream_unsubscribe(subscriber)
@@ -0,0 +1,70 @@
+import time
+
+from lib.redis import get_redis
+
+
+# === 价格时间序列（每个 symbol 一个 Redis list 作为环形缓冲）===
+TS_KEY_PREFIX = "price_ts:"
+TS_SYMBOLS_KEY = f"{TS_KEY_PREFIX}symbols"  # set：有时间序列的 symbol
+TS_MAX_POINTS = 2016                        # 每个 symbol 最多保留的点数（5 分钟一次约 7 天）
+
+
+def ts_key(symbol):
+    return f"{TS_KEY_PREFIX}{symbol}"
+
+
+def ts_append(quotes, max_points=TS_MAX_POINTS):
+    """
+    追加报价到各 symbol 的环形缓冲：一次 pipeline 内完成 RPUSH + LTRIM
+
+    每个点编码为 "ts,price,change" 紧凑字符串
+    :param quotes: {symbol: {"price", "change_24h", "ts"(可选)}}
+    """
+    redis_client = get_redis()
+    if not redis_client or not quotes:
+        return
+
+    now = time.time()
+    pipe = redis_client.pipeline(transaction=False)
+    for symbol, quote in quotes.items():
+        key = ts_key(symbol)
+        pipe.rpush(key, f"{quote.get('ts', now):.0f},{quote['price']!r},{quote['change_24h']!r}")
+        pipe.ltrim(key, -max_points, -1)
+    pipe.sadd(TS_SYMBOLS_KEY, *quotes)
+    pipe.execute()
+
+
+def ts_symbols():
+    """所有有时间序列的 symbol"""
+    redis_client = get_redis()
+    if not redis_client:
+        return []
+    return sorted(redis_client.smembers(TS_SYMBOLS_KEY))
+
+
+def ts_load(symbols, limit=TS_MAX_POINTS):
+    """
+    批量读取时间序列（一次 pipeline）
+
+    返回 {symbol: [(ts, price, change), ...]}，按时间升序
+    """
+    redis_client = get_redis()
+    if not redis_client or not symbols:
+        return {}
+
+    pipe = redis_client.pipeline(transaction=False)
+    for symbol in symbols:
+        pipe.lrange(ts_key(symbol), -limit, -1)
+
+    series = {}
+    for symbol, rows in zip(symbols, pipe.execute()):
+        points = []
+        for row in rows:
+            try:
+                ts, price, change = row.split(",")
+                points.append((float(ts), float(price), float(change)))
+            except ValueError:
+                continue
+        if points:
+            series[symbol] = points
+    return series
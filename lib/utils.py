@@ -1,16 +1,20 @@
 from flask import request, jsonify
-import os
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
+from lib.config import env
 
-API_SECRET = os.getenv("API_SECRET")
 
-def register_token_verifier(app):
+def register_token_verifier(app, exempt_endpoints=()):
+    """
+    所有路由校验 x-api-token；exempt_endpoints 中的 endpoint（如健康检查）跳过校验
+    """
     @app.before_request
     def verify_token():
+        if request.endpoint in exempt_endpoints:
+            return None
         token = request.headers.get("x-api-token")
-        if token != API_SECRET:
+        if token != env("API_SECRET"):
             return jsonify({"error": "Invalid token"}), 401
         
 
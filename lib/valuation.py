@@ -0,0 +1,154 @@
+import json
+from datetime import datetime, timezone
+import numpy as np
+
+from lib.notion import notion_edited_since, notion_get_holdings_rows
+from lib.prices import get_price_data
+from lib.redis import get_redis
+
+
+# === 持仓缓存（从 Holdings 提取的数量 / 成本）===
+POSITIONS_KEY_PREFIX = "holdings_positions:"
+# 读取缓存时查询 Holdings 在缓存之后是否有修改（last_edited_time），有则重新读取；
+# 数量 / 成本的 rollup 随关联页面变化时不会更新 Holdings 的 last_edited_time，由较短的 TTL 兜底
+POSITIONS_TTL = 600
+
+
+def _number_value(prop):
+    """读取 number / formula / rollup 类型属性的数值"""
+    if not prop:
+        return None
+    kind = prop.get("type") or next((k for k in ("number", "formula", "rollup") if k in prop), None)
+    value = prop.get(kind)
+    if isinstance(value, dict):
+        value = value.get("number")
+    return value
+
+
+def _positions_key(HOLDINGS_DB_ID):
+    return f"{POSITIONS_KEY_PREFIX}{HOLDINGS_DB_ID}"
+
+
+def position_from_row(row):
+    """Holdings 行 → 持仓 {"symbol", "quantity", "cost", "notion_market_value"}"""
+    props = row["properties"]
+    title_arr = props.get("币种", {}).get("title", [])
+    return {
+        "symbol": title_arr[0]["plain_text"].strip().upper() if title_arr else "",
+        "quantity": _number_value(props.get("当前持仓数量")) or 0,
+        "cost": _number_value(props.get("总买入成本")) or 0,
+        # Notion 公式市值：本地没有价格时兜底
+        "notion_market_value": _number_value(props.get("当前市值")) or 0
+    }
+
+
+def get_cached_positions(notion, HOLDINGS_DB_ID):
+    """读取持仓缓存；缓存之后 Holdings 有修改时失效并返回 None"""
+    redis_client = get_redis()
+    cached = redis_client.get(_positions_key(HOLDINGS_DB_ID)) if redis_client else None
+    if not cached:
+        return None
+    cached = json.loads(cached)
+    if notion_edited_since(notion, HOLDINGS_DB_ID, datetime.fromisoformat(cached["scanned_at"])):
+        invalidate_positions(HOLDINGS_DB_ID)
+        return None
+    return cached["positions"]
+
+
+def cache_positions(HOLDINGS_DB_ID, positions, scanned_at: datetime):
+    """写入持仓缓存；scanned_at 为读取 Holdings 开始的时间（UTC），用于之后的修改检查"""
+    redis_client = get_redis()
+    if redis_client:
+        redis_client.setex(_positions_key(HOLDINGS_DB_ID), POSITIONS_TTL, json.dumps({
+            "positions": positions,
+            "scanned_at": scanned_at.isoformat()
+        }))
+
+
+def load_positions(notion, HOLDINGS_DB_ID, refresh=False):
+    """
+    读取持仓列表：优先 Redis 缓存（Holdings 未修改时），缺失或 refresh=True 时流式读取 Holdings 并回写缓存
+
+    返回 [{"symbol", "quantity", "cost", "notion_market_value"}]，每个 Holdings 行一项
+    """
+    if not refresh:
+        cached = get_cached_positions(notion, HOLDINGS_DB_ID)
+        if cached is not None:
+            return cached
+
+    scanned_at = datetime.now(timezone.utc)
+    positions = [position_from_row(row) for row in notion_get_holdings_rows(notion, HOLDINGS_DB_ID)]
+    cache_positions(HOLDINGS_DB_ID, positions, scanned_at)
+    return positions
+
+
+def invalidate_positions(HOLDINGS_DB_ID):
+    redis_client = get_redis()
+    if redis_client:
+        redis_client.delete(_positions_key(HOLDINGS_DB_ID))
+
+
+def value_positions(positions, price_data):
+    """
+    向量化估值：持仓数量 × 缓存价格
+
+    没有价格的持仓回退到 Notion 公式市值，并在 unpriced 中列出
+    """
+    symbols = np.array([p["symbol"] for p in positions], dtype=object)
+    quantity = np.array([p["quantity"] for p in positions], dtype=np.float64)
+    cost = np.array([p["cost"] for p in positions], dtype=np.float64)
+    fallback = np.array([p["notion_market_value"] for p in positions], dtype=np.float64)
+    price = np.array([
+        (price_data.get(symbol) or {}).get("price", np.nan) for symbol in symbols
+    ], dtype=np.float64)
+
+    priced = np.isfinite(price)
+    market_value = np.where(priced, quantity * np.nan_to_num(price), fallback)
+
+    # 按币种聚合（同一币种可能分布在多个账本）
+    asset_symbols, inverse = np.unique(symbols.astype(str), return_inverse=True)
+    asset_quantity = np.bincount(inverse, weights=quantity, minlength=len(asset_symbols))
+    asset_value = np.bincount(inverse, weights=market_value, minlength=len(asset_symbols))
+    asset_cost = np.bincount(inverse, weights=cost, minlength=len(asset_symbols))
+
+    total_market_value = float(market_value.sum())
+    total_invested = float(cost.sum())
+
+    return {
+        "total_market_value": total_market_value,
+        "total_invested": total_invested,
+        "total_pnl": total_market_value - total_invested,
+        "asset_count": len(positions),
+        "assets": [
+            {
+                "symbol": asset_symbols[i],
+                "quantity": float(asset_quantity[i]),
+                "price": (price_data.get(asset_symbols[i]) or {}).get("price"),
+                "market_value": float(asset_value[i]),
+                "cost": float(asset_cost[i]),
+                "pnl": float(asset_value[i] - asset_cost[i])
+            }
+            for i in range(len(asset_symbols))
+        ],
+        "unpriced": sorted(set(symbols[~priced].astype(str)))
+    }
+
+
+def positions_price_data(api_key, positions, currency="USD", rates=None):
+    """
+    持仓涉及币种的报价，按 currency 换算
+
+    成本与兜底市值来自 Notion，价格须换算成 Notion 使用的货币（NOTION_PRICE_CURRENCY）才能相加
+    """
+    symbols = sorted({p["symbol"] for p in positions if p["symbol"]})
+    price_data = get_price_data(api_key, symbols) if symbols else {}
+    if currency == "USD":
+        return price_data
+    from lib.rates import price_data_in
+    return price_data_in(price_data, currency, rates)
+
+
+def compute_portfolio_valuation(notion, api_key, HOLDINGS_DB_ID, refresh_positions=False, currency="USD", rates=None):
+    """缓存持仓 + 价格缓存（stale-while-revalidate）计算账户估值，价格按 currency 换算"""
+    positions = load_positions(notion, HOLDINGS_DB_ID, refresh=refresh_positions)
+    return value_positions(positions, positions_price_data(api_key, positions, currency, rates))
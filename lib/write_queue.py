@@ -0,0 +1,184 @@
+import json
+import time
+
+from lib.notion import notion_plan_updates, notion_record_written, notion_update_pages
+from lib.redis import get_redis, single_flight
+
+
+# === Notion 写入队列（write-behind）===
+# jobs:  hash  page_id -> 最新待写入的 {"symbol", "properties", "value", "attempts"}（新价格覆盖旧的，天然合并）
+# since: hash  page_id -> 首次入队时间（合并不会刷新，用于计算积压延迟）
+# order: list  page_id 的 FIFO 顺序；只有 page_id 在 jobs 中是新字段时才 RPUSH，保证每页只排一次
+WRITE_QUEUE_KEY_PREFIX = "notion_wq:"
+WRITE_QUEUE_JOBS_KEY = f"{WRITE_QUEUE_KEY_PREFIX}jobs"
+WRITE_QUEUE_SINCE_KEY = f"{WRITE_QUEUE_KEY_PREFIX}since"
+WRITE_QUEUE_ORDER_KEY = f"{WRITE_QUEUE_KEY_PREFIX}order"
+
+WRITE_QUEUE_DRAIN_LIMIT = 500     # 单次 drain 最多处理的任务数
+WRITE_QUEUE_BATCH_SIZE = 50       # 每批认领并并发写入的任务数（速率由 Notion 令牌桶控制）
+WRITE_QUEUE_MAX_ATTEMPTS = 5      # 写入失败重新入队的次数上限，超过后丢弃
+WRITE_QUEUE_DRAIN_LOCK_TTL = 300  # 秒，同一时间只有一个 drain 在运行
+
+
+def write_queue_enqueue(updates: dict, suppressed: dict = None):
+    """
+    把页面更新写入队列（同一页面的待写任务被新价格覆盖）
+
+    :param updates: notion_plan_updates 返回的 {symbol: (page_id, properties, value)}
+    :param suppressed: {symbol: page_id}；当前价格与 Notion 已写入值接近，丢弃这些页面上较旧的待写任务
+    :return: 新入队（此前没有待写任务）的页面数
+    """
+    redis_client = get_redis()
+    if not redis_client or not (updates or suppressed):
+        return 0
+
+    now = time.time()
+    page_ids = [page_id for page_id, _, _ in updates.values()]
+
+    pipe = redis_client.pipeline(transaction=False)
+    for symbol, (page_id, properties, value) in updates.items():
+        pipe.hset(WRITE_QUEUE_JOBS_KEY, page_id, json.dumps({
+            "symbol": symbol,
+            "properties": properties,
+            "value": value,
+            "attempts": 0
+        }))
+        pipe.hsetnx(WRITE_QUEUE_SINCE_KEY, page_id, now)
+    stale = list((suppressed or {}).values())
+    if stale:
+        pipe.hdel(WRITE_QUEUE_JOBS_KEY, *stale)
+        pipe.hdel(WRITE_QUEUE_SINCE_KEY, *stale)
+    results = pipe.execute()
+
+    # HSET 返回 1 表示 page_id 是新字段：之前没有排队，追加到顺序列表
+    added = [page_id for page_id, created in zip(page_ids, results[0:len(page_ids) * 2:2]) if created]
+    if added:
+        redis_client.rpush(WRITE_QUEUE_ORDER_KEY, *added)
+    return len(added)
+
+
+def _write_queue_claim(limit):
+    """
+    认领最多 limit 个任务：LPOP 顺序列表，再在一个事务内读取并删除对应任务
+
+    认领后的新价格会作为新字段重新入队，不会丢失
+    """
+    redis_client = get_redis()
+    page_ids = redis_client.lpop(WRITE_QUEUE_ORDER_KEY, limit) or []
+    page_ids = list(dict.fromkeys(page_ids))
+    if not page_ids:
+        return []
+
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hmget(WRITE_QUEUE_JOBS_KEY, page_ids)
+    pipe.hmget(WRITE_QUEUE_SINCE_KEY, page_ids)
+    pipe.hdel(WRITE_QUEUE_JOBS_KEY, *page_ids)
+    pipe.hdel(WRITE_QUEUE_SINCE_KEY, *page_ids)
+    payloads, since, _, _ = pipe.execute()
+
+    # 顺序列表中可能残留已被丢弃（suppressed）的 page_id，读不到任务时跳过
+    return [
+        (page_id, json.loads(payload), float(enqueued_at or time.time()))
+        for page_id, payload, enqueued_at in zip(page_ids, payloads, since)
+        if payload
+    ]
+
+
+def _write_queue_requeue(page_id, job, enqueued_at):
+    """写入失败的任务放回队列；期间已有更新的任务入队时以新任务为准"""
+    redis_client = get_redis()
+    job = dict(job, attempts=job.get("attempts", 0) + 1)
+    if job["attempts"] >= WRITE_QUEUE_MAX_ATTEMPTS:
+        print(f"Notion 写入任务 {job['symbol']}（{page_id}）失败 {job['attempts']} 次，丢弃")
+        return False
+    if redis_client.hsetnx(WRITE_QUEUE_JOBS_KEY, page_id, json.dumps(job)):
+        redis_client.hsetnx(WRITE_QUEUE_SINCE_KEY, page_id, enqueued_at)
+        redis_client.rpush(WRITE_QUEUE_ORDER_KEY, page_id)
+    return True
+
+
+def _write_queue_repair():
+    """顺序列表为空但仍有任务时（认领过程中实例崩溃），把剩余 page_id 重新排队"""
+    redis_client = get_redis()
+    if redis_client.llen(WRITE_QUEUE_ORDER_KEY) == 0:
+        orphans = redis_client.hkeys(WRITE_QUEUE_JOBS_KEY)
+        if orphans:
+            redis_client.rpush(WRITE_QUEUE_ORDER_KEY, *orphans)
+
+
+def write_queue_stats():
+    """队列深度（待写页面数）与积压延迟（最早待写任务的等待秒数）"""
+    redis_client = get_redis()
+    if not redis_client:
+        return {"depth": 0, "lag_seconds": 0.0}
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hlen(WRITE_QUEUE_JOBS_KEY)
+    pipe.hvals(WRITE_QUEUE_SINCE_KEY)
+    depth, since = pipe.execute()
+    oldest = min((float(value) for value in since), default=None)
+    return {
+        "depth": depth,
+        "lag_seconds": round(max(time.time() - oldest, 0.0), 3) if oldest else 0.0
+    }
+
+
+def notion_enqueue_price_updates(symbol_to_page, price_data, PRICE_FIELD, CHANGE_FIELD, epsilon=None):
+    """
+    write-behind 模式的刷新：只计算需要写入的页面并入队，不访问 Notion
+
+    返回 {"enqueued": 需要写入的页面数, "new": 新增排队的页面数, "suppressed": 跳过的页面数}
+    没有 Redis 时抛出 RuntimeError（队列无处保存，不能报告为已入队）
+    """
+    if not get_redis():
+        raise RuntimeError("Write queue requires Redis")
+    updates, suppressed = notion_plan_updates(symbol_to_page, price_data, PRICE_FIELD, CHANGE_FIELD, epsilon)
+    new = write_queue_enqueue(updates, suppressed)
+    return {"enqueued": len(updates), "new": new, "suppressed": len(suppressed)}
+
+
+def notion_drain_write_queue(notion, limit=WRITE_QUEUE_DRAIN_LIMIT, batch_size=WRITE_QUEUE_BATCH_SIZE):
+    """
+    分批把队列中的任务写入 Notion（并发与速率由 notion_update_pages 的令牌桶 / AIMD 控制）
+
+    同一时间只有一个 drain 运行；返回 {"status", "written", "failed", "dropped", "queue"}
+    """
+    if not get_redis():
+        return {"status": "skipped", "message": "Redis unavailable", "queue": write_queue_stats()}
+
+    with single_flight("notion_write_queue_drain", ttl=WRITE_QUEUE_DRAIN_LOCK_TTL, wait_timeout=0) as leader:
+        if not leader:
+            return {"status": "busy", "queue": write_queue_stats()}
+
+        _write_queue_repair()
+        processed, written, failed, dropped = 0, 0, {}, 0
+
+        while processed < limit:
+            jobs = _write_queue_claim(min(batch_size, limit - processed))
+            if not jobs:
+                break
+            processed += len(jobs)
+
+            results = notion_update_pages(notion, {
+                page_id: (page_id, job["properties"]) for page_id, job, _ in jobs
+            })
+
+            notion_record_written({
+                page_id: job["value"] for page_id, job, _ in jobs if results[page_id]["status"] == "ok"
+            })
+            for page_id, job, enqueued_at in jobs:
+                if results[page_id]["status"] == "ok":
+                    written += 1
+                    continue
+                failed[job["symbol"]] = results[page_id]["error"]
+                # 页面已删除 / 归档：重试没有意义，直接丢弃（索引在下次刷新时剔除该页面）
+                if results[page_id].get("removed") or not _write_queue_requeue(page_id, job, enqueued_at):
+                    dropped += 1
+
+        return {
+            "status": "success",
+            "written": written,
+            "failed": failed,
+            "dropped": dropped,
+            "queue": write_queue_stats()
+        }